@@ -0,0 +1,147 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from loader import expand_sources
+from metrics import layer_metrics
+from report import create_report, write_batch_summary
+from compare import read_pairs, load_pair, similarity
+from constants import THRESHOLD
+
+
+
+
+#number of images stacked and scored together
+CHUNK_IMAGES = 32
+
+#metrics of every image kept for each layer, in the order they are stored in the results file
+IMAGE_METRICS = ['similarity', 'min', 'below', 'abs_error', 'max_error', 'cosine', 'snr', 'ulp_mean', 'ulp_max']
+
+
+
+
+'''
+    Description:
+        compares the layer outputs of many input images at once and summarizes them, instead of one workbook per image.
+        batchDir holds one directory per image, each with a caffe and a cpp directory laid out the way auto_compare
+        expects (a filenames.txt listing the layers in the same order for every image). Images are parsed in worker
+        processes; the parsed layers of a chunk of images are stacked along a new first axis and scored together.
+    Inputs:
+        excelFileName - name of the summary excel file to be created
+        batchDir - directory with one directory per image
+        resultsFile - name of the .npz file the results are saved to. Defaults to excelFileName with a .npz extension.
+        caffeDir - name of the directory of caffe outputs inside each image's directory
+        cppDir - name of the directory of cpp outputs inside each image's directory
+        workers - number of processes parsing images. The next chunk is parsed while the current one is scored.
+        chunkSize - number of images stacked and scored at a time
+        threshold - similarities at or below this count as failing
+        cacheDir - optional directory to keep parsed copies of the text files in, see compare.compare
+    Outputs:
+        returns the dict saved to resultsFile:
+            images, layers - names of the images (their directories) and layers
+            threshold - the threshold used
+            <layer>/<metric> - one value per image for every metric in IMAGE_METRICS. similarity is the ave_error
+                               auto_compare writes for that image, min the lowest similarity, below the fraction at or
+                               below threshold, the rest are from metrics.layer_metrics
+            <layer>/mean_map, <layer>/min_map - mean and lowest similarity of every value across the images, in the
+                                                layer's tensor shape
+'''
+def batch_compare(excelFileName, batchDir, resultsFile=None, caffeDir='caffe', cppDir='vivado', workers=1, chunkSize=CHUNK_IMAGES, threshold=THRESHOLD, cacheDir=None):
+
+    if resultsFile is None:
+        resultsFile = os.path.splitext(excelFileName)[0] + '.npz'
+
+    #every directory with a caffe directory in it is an image, in natural order
+    imageDirs = [os.path.dirname(path) for path in expand_sources(os.path.join(batchDir, '*', caffeDir))]
+    images = [os.path.basename(path) for path in imageDirs]
+    pairs = [read_pairs(os.path.join(path, caffeDir) + os.sep, os.path.join(path, cppDir) + os.sep) for path in imageDirs]
+    layers = [os.path.basename(pair[0])[:-4] for pair in pairs[0]]
+    for imagePairs in pairs:
+        assert len(imagePairs) == len(layers)
+
+    results = {'images': np.array(images), 'layers': np.array(layers), 'threshold': threshold}
+    columns = {(layer, key): [] for layer in layers for key in IMAGE_METRICS}
+    sums = [None] * len(layers)
+    mins = [None] * len(layers)
+    shapes = [None] * len(layers)
+
+    chunks = [range(start, min(start + chunkSize, len(images))) for start in range(0, len(images), chunkSize)]
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        pending = _submit(pool, pairs, chunks[0], cacheDir) if chunks else None
+        for n, chunk in enumerate(chunks):
+            loaded = [future.result() if pool is not None else future for future in pending]
+
+            #start parsing the next chunk before scoring this one
+            if n + 1 < len(chunks):
+                pending = _submit(pool, pairs, chunks[n + 1], cacheDir)
+
+            for j in range(len(layers)):
+                if shapes[j] is None:
+                    shapes[j] = loaded[0][j][0].shape
+                caffe = np.stack([image[j][0].reshape(-1) for image in loaded])
+                cpp = np.stack([image[j][1].reshape(-1) for image in loaded])
+                assert caffe.shape[1] == int(np.prod(shapes[j]))
+
+                scores = _score_chunk(caffe, cpp, threshold)
+                for key in IMAGE_METRICS:
+                    columns[(layers[j], key)].append(scores[key])
+
+                error = scores['error']
+                sums[j] = error.sum(axis=0) if sums[j] is None else sums[j] + error.sum(axis=0)
+                mins[j] = error.min(axis=0) if mins[j] is None else np.minimum(mins[j], error.min(axis=0))
+
+            print('finished images {}-{} of {}'.format(chunk[0] + 1, chunk[-1] + 1, len(images)))
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    for j, layer in enumerate(layers):
+        for key in IMAGE_METRICS:
+            results[layer + '/' + key] = np.concatenate(columns[(layer, key)]) if columns[(layer, key)] else np.zeros(0)
+        if sums[j] is not None:
+            results[layer + '/mean_map'] = (sums[j] / len(images)).reshape(shapes[j])
+            results[layer + '/min_map'] = mins[j].reshape(shapes[j])
+
+    np.savez_compressed(resultsFile, **results)
+
+    workbook = create_report(excelFileName)
+    write_batch_summary(workbook, results, threshold)
+    workbook.close()
+
+    return results
+
+
+
+
+#loads every layer of one image in its tensor shape, the part of a batch that runs in the worker processes
+def _load_image(imagePairs, cacheDir=None):
+    return [load_pair(caffePath, cppPath, cacheDir, keepShape=True) for caffePath, cppPath, _, _, _ in imagePairs]
+
+
+
+
+#starts loading the images of a chunk, in the pool if there is one. Without a pool they are loaded straight away
+def _submit(pool, pairs, chunk, cacheDir):
+    if pool is None:
+        return [_load_image(pairs[i], cacheDir) for i in chunk]
+    return [pool.submit(_load_image, pairs[i], cacheDir) for i in chunk]
+
+
+
+
+#scores one layer of a chunk of images, stacked as (images, values)
+def _score_chunk(caffe, cpp, threshold):
+    error, _ = similarity(caffe, cpp)
+
+    #every image is a channel to layer_metrics
+    metrics = layer_metrics(caffe, cpp)['channels']
+    return {'error': error,
+            'similarity': np.average(error, axis=1),
+            'min': error.min(axis=1),
+            'below': np.count_nonzero(error <= threshold, axis=1) / error.shape[1],
+            'abs_error': metrics['abs_error'],
+            'max_error': metrics['max_error'],
+            'cosine': metrics['cosine'],
+            'snr': metrics['snr'],
+            'ulp_mean': metrics['ulp_mean'],
+            'ulp_max': metrics['ulp_max']}
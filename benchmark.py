@@ -0,0 +1,413 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import tracemalloc
+import numpy as np
+from types import SimpleNamespace
+from loader import load_source
+from metrics import layer_metrics
+from report import create_report, write_layer
+from compare import similarity, to_2d, convert_to_2d, mergeFiles, auto_compare, write_caffe_files
+
+
+
+
+#file the results of every run are appended to
+HISTORY_FILE = 'benchmark_history.json'
+
+#a stage is reported as a regression when it is this fraction slower, or uses this fraction more memory, than the
+#median of the last HISTORY_WINDOW runs of the same model and scale
+TIME_THRESHOLD = 0.25
+MEMORY_THRESHOLD = 0.25
+HISTORY_WINDOW = 5
+
+#differences smaller than this many seconds are timer noise and never reported
+MIN_TIME = 0.05
+
+#fixed point step of the synthetic cpp outputs, like an ap_fixed with 12 fractional bits
+CPP_STEP = 2.0 ** -12
+
+STAGES = ['convert', 'merge', 'parse', 'metric', 'report', 'auto_compare', 'serialize']
+
+#(layer name, shape of the layer's output, shape of its weights or None) for a batch of one image.
+#The resnet and vgg tables are a representative layer from each stage of ResNet-50 and VGG-16 rather than every layer
+MODELS = {
+    'cifar10': [('conv1', (32, 32, 32), (32, 3, 5, 5)),
+                ('pool1', (32, 16, 16), None),
+                ('conv2', (32, 16, 16), (32, 32, 5, 5)),
+                ('pool2', (32, 8, 8), None),
+                ('conv3', (64, 8, 8), (64, 32, 5, 5)),
+                ('pool3', (64, 4, 4), None),
+                ('ip1', (64,), (64, 1024)),
+                ('ip2', (10,), (10, 64))],
+    'resnet': [('conv1', (64, 112, 112), (64, 3, 7, 7)),
+               ('res2a_branch2b', (64, 56, 56), (64, 64, 3, 3)),
+               ('res3a_branch2b', (128, 28, 28), (128, 128, 3, 3)),
+               ('res4a_branch2b', (256, 14, 14), (256, 256, 3, 3)),
+               ('res5a_branch2b', (512, 7, 7), (512, 512, 3, 3)),
+               ('fc1000', (1000,), (1000, 2048))],
+    'vgg': [('conv1_2', (64, 224, 224), (64, 64, 3, 3)),
+            ('conv2_2', (128, 112, 112), (128, 128, 3, 3)),
+            ('conv3_3', (256, 56, 56), (256, 256, 3, 3)),
+            ('conv4_3', (512, 28, 28), (512, 512, 3, 3)),
+            ('conv5_3', (512, 14, 14), (512, 512, 3, 3)),
+            ('fc8', (1000,), (1000, 4096))],
+}
+
+
+
+
+'''
+    Description:
+        generates the caffe and vivado dumps of a model's layers in the formats the tool is used with. Caffe outputs are
+        bracketed [[[ ... ]]] dumps, vivado outputs are split into one tab separated file per channel (fc outputs one value
+        per line) with crlf line endings, and both directories get a filenames.txt listing the layers in order.
+        The cpp values are the caffe values rounded to CPP_STEP, so the similarities are realistic. The same seed always
+        gives the same files.
+    Inputs:
+        model - key of MODELS
+        workDir - directory to create caffe/ and vivado/ in
+        scale - the number of channels of every layer is divided by this, for quicker runs of the large models
+        seed - seed of the random values
+    Outputs:
+        returns a list of (name, caffe file, list of vivado files, shape) tuples, one per layer
+'''
+def generate_model(model, workDir, scale=1, seed=0):
+    rng = np.random.default_rng(seed)
+    caffeDir = os.path.join(workDir, 'caffe') + os.sep
+    cppDir = os.path.join(workDir, 'vivado') + os.sep
+    os.makedirs(caffeDir, exist_ok=True)
+    os.makedirs(cppDir, exist_ok=True)
+
+    layers = []
+    caffeNames = []
+    cppNames = []
+    for name, shape, weights in MODELS[model]:
+        shape = scale_shape(shape, scale)
+        caffe = (rng.standard_normal(shape) * 20).astype(np.float32)
+        cpp = np.round(caffe / CPP_STEP) * CPP_STEP
+
+        caffeFile = caffeDir + name + '.txt'
+        write_caffe_dump(caffeFile, caffe)
+        cppFiles = write_vivado_dump(cppDir + name, cpp)
+
+        caffeNames.append(name + '.txt')
+        cppNames.append(name + 'out*.txt' if len(cppFiles) > 1 else os.path.basename(cppFiles[0]))
+        layers.append((name, caffeFile, cppFiles, shape))
+
+    with open(caffeDir + 'filenames.txt', 'w') as f:
+        f.write(''.join(n + '\n' for n in caffeNames))
+    with open(cppDir + 'filenames.txt', 'w') as f:
+        f.write(''.join(n + '\n' for n in cppNames))
+
+    return layers
+
+
+
+
+'''
+    Description:
+        builds an object that looks enough like a caffe net after a forward pass for write_caffe_files, with the model's
+        outputs as blobs and random weights and biases for every layer that has them
+    Inputs:
+        model - key of MODELS
+        scale - the number of channels of every layer is divided by this
+        seed - seed of the random values
+    Outputs:
+        returns the net, with blobs and params dicts in layer order
+'''
+def synthetic_net(model, scale=1, seed=0):
+    rng = np.random.default_rng(seed)
+    blobs = {}
+    params = {}
+    for name, shape, weights in MODELS[model]:
+        shape = scale_shape(shape, scale)
+        blobs[name] = SimpleNamespace(data=rng.standard_normal((1,) + shape).astype(np.float32))
+        if weights is not None:
+            weights = scale_shape(weights, scale, 2 if len(weights) == 4 else 1)
+            params[name] = [SimpleNamespace(data=(rng.standard_normal(weights) * 0.1).astype(np.float32)),
+                            SimpleNamespace(data=(rng.standard_normal(weights[0]) * 0.1).astype(np.float32))]
+    return SimpleNamespace(blobs=blobs, params=params)
+
+
+
+
+#divides the leading channel dimensions of a shape by scale, keeping at least one channel
+def scale_shape(shape, scale, numChannelDims=1):
+    return tuple(max(1, int(n // scale)) if i < numChannelDims else n for i, n in enumerate(shape))
+
+
+
+
+#writes an array as a bracketed dump like caffe's, 8 significant digits in scientific notation with one row per line
+def write_caffe_dump(fileName, arr):
+    with open(fileName, 'w') as f:
+        if arr.ndim == 1:
+            f.write('[' + '\n '.join(' '.join(map('{: .8e}'.format, arr[i:i + 4].tolist())) for i in range(0, len(arr), 4)) + ']\n')
+            return
+
+        f.write('[')
+        for c in range(arr.shape[0]):
+            rows = ('[' + ' '.join(map('{: .8e}'.format, row.tolist())) + ']' for row in arr[c])
+            f.write(('\n\n [' if c else '[') + '\n  '.join(rows) + ']')
+        f.write(']\n')
+
+
+
+
+#writes an array the way the vivado testbench does, one file per channel named prefix + 'out1.txt', 'out2.txt', ... or a
+#single prefix + '.txt' column for 1 dimensional outputs. Returns the list of files
+def write_vivado_dump(prefix, arr):
+    if arr.ndim == 1:
+        with open(prefix + '.txt', 'wb') as f:
+            np.savetxt(f, arr, fmt='%f', newline='\r\n')
+        return [prefix + '.txt']
+
+    files = []
+    for c in range(arr.shape[0]):
+        files.append(prefix + 'out' + str(c + 1) + '.txt')
+        with open(files[-1], 'wb') as f:
+            np.savetxt(f, arr[c], fmt='%f', delimiter='\t', newline='\t\r\n')
+    return files
+
+
+
+
+'''
+    Description:
+        times a function and measures the memory it allocates. The time is the fastest of repeat calls; the memory is
+        measured on one more call with tracemalloc, which numpy reports its arrays to, so tracing does not slow the timed calls.
+    Inputs:
+        fn - function to call with no arguments
+        repeat - number of timed calls
+    Outputs:
+        returns a dict with time and cpu (seconds of the fastest call) and peak_bytes (most memory held at once)
+'''
+def measure(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        fn()
+        result = {'time': time.perf_counter() - wall, 'cpu': time.process_time() - cpu}
+        if best is None or result['time'] < best['time']:
+            best = result
+
+    tracemalloc.start()
+    try:
+        fn()
+        best['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best
+
+
+
+
+'''
+    Description:
+        benchmarks every stage of the tool on a synthetic model
+            convert - convert_to_2d of each caffe dump
+            merge - mergeFiles of each layer's vivado files
+            parse - loading both outputs of each layer
+            metric - similarity and layer_metrics of each layer
+            report - writing and closing a workbook with each layer's sheets
+            auto_compare - the whole comparison of the model
+            serialize - write_caffe_files of the model's blobs, weights and biases
+    Inputs:
+        model - key of MODELS
+        scale - the number of channels of every layer is divided by this
+        repeat - number of timed calls of each stage, the fastest is kept
+        stages - list of stages to run, all of STAGES by default
+        workDir - directory for the generated files. A temporary directory that is removed afterwards by default.
+    Outputs:
+        returns a dict describing the run, with the results of each stage under 'stages'. Per layer stages have the
+        results of each layer under 'layers' and their sum (time) and maximum (peak_bytes) at the top.
+'''
+def run_benchmarks(model, scale=1, repeat=3, stages=None, workDir=None):
+    if stages is None:
+        stages = STAGES
+    tmpDir = None
+    if workDir is None:
+        workDir = tmpDir = tempfile.mkdtemp(prefix='benchmark_')
+
+    try:
+        print('generating ' + model + ' layers')
+        layers = generate_model(model, workDir, scale)
+        outDir = os.path.join(workDir, 'out') + os.sep
+        os.makedirs(outDir, exist_ok=True)
+        caffeDir = os.path.join(workDir, 'caffe') + os.sep
+        cppDir = os.path.join(workDir, 'vivado') + os.sep
+
+        results = {}
+        for stage in stages:
+            if stage == 'auto_compare':
+                results[stage] = measure(lambda: auto_compare(outDir + 'auto_compare.xlsx', caffeDir, cppDir), repeat)
+            elif stage == 'serialize':
+                net = synthetic_net(model, scale)
+                results[stage] = measure(lambda: write_caffe_files(net, outDir, outDir, outDir), repeat)
+            else:
+                perLayer = {}
+                for name, caffeFile, cppFiles, shape in layers:
+                    fn = _layer_stage(stage, name, caffeFile, cppFiles, outDir)
+                    if fn is not None:
+                        perLayer[name] = measure(fn, repeat)
+                results[stage] = {'time': sum(r['time'] for r in perLayer.values()),
+                                  'cpu': sum(r['cpu'] for r in perLayer.values()),
+                                  'peak_bytes': max([r['peak_bytes'] for r in perLayer.values()] + [0]),
+                                  'layers': perLayer}
+            print(stage + ' finished in {:.3f}s'.format(results[stage]['time']))
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+    return {'model': model,
+            'scale': scale,
+            'repeat': repeat,
+            'values': int(sum(np.prod(shape) for name, c, f, shape in layers)),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'stages': results}
+
+
+
+
+#the function one per layer stage runs for a layer, or None if the stage has nothing to do for it
+def _layer_stage(stage, name, caffeFile, cppFiles, outDir):
+    if stage == 'convert':
+        return lambda: convert_to_2d(caffeFile, outDir + name + '_2d.txt')
+    if stage == 'merge':
+        if len(cppFiles) == 1:
+            return None
+        return lambda: mergeFiles(cppFiles, outDir + name + '_merged.txt')
+    if stage == 'parse':
+        return lambda: (load_source(caffeFile, dtype=np.float64), load_source(cppFiles, dtype=np.float64))
+
+    caffe = load_source(caffeFile, dtype=np.float64)
+    cpp = load_source(cppFiles, dtype=np.float64).reshape(caffe.shape)
+    if stage == 'metric':
+        return lambda: (similarity(to_2d(caffe), to_2d(cpp)), layer_metrics(caffe, cpp))
+    if stage == 'report':
+        def report():
+            caffe2d, cpp2d = to_2d(caffe), to_2d(cpp)
+            error, ave_error = similarity(caffe2d, cpp2d)
+            workbook = create_report(outDir + name + '.xlsx')
+            write_layer(workbook, caffe2d, cpp2d, error, ave_error)
+            workbook.close()
+        return report
+    raise ValueError('unknown stage ' + stage)
+
+
+
+
+'''
+    Description:
+        reads the results of earlier runs
+    Inputs:
+        historyFile - json file the runs are kept in
+    Outputs:
+        returns a list of the runs from run_benchmarks, oldest first. Empty if the file does not exist yet.
+'''
+def read_history(historyFile=HISTORY_FILE):
+    if not os.path.exists(historyFile):
+        return []
+    with open(historyFile, 'r') as f:
+        return json.load(f)
+
+
+
+
+'''
+    Description:
+        appends a run to the history file
+    Inputs:
+        run - dict from run_benchmarks
+        historyFile - json file the runs are kept in
+    Outputs:
+        does not return anything but the run has been added to the file
+'''
+def save_run(run, historyFile=HISTORY_FILE):
+    history = read_history(historyFile)
+    history.append(run)
+    tmpFile = historyFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmpFile, historyFile)
+
+
+
+
+'''
+    Description:
+        compares a run with the earlier runs of the same model and scale. Each stage's time and peak memory are compared
+        with their median over the last HISTORY_WINDOW runs.
+    Inputs:
+        run - dict from run_benchmarks
+        history - list of earlier runs from read_history
+        timeThreshold - fraction a stage can be slower than its baseline before it is reported
+        memoryThreshold - fraction a stage can use more memory than its baseline before it is reported
+    Outputs:
+        returns a list of strings describing each regression, empty if there are none or there is nothing to compare with
+'''
+def check_regressions(run, history, timeThreshold=TIME_THRESHOLD, memoryThreshold=MEMORY_THRESHOLD):
+    previous = [r for r in history if r['model'] == run['model'] and r['scale'] == run['scale']][-HISTORY_WINDOW:]
+
+    regressions = []
+    for stage, result in run['stages'].items():
+        times = [r['stages'][stage]['time'] for r in previous if stage in r['stages']]
+        peaks = [r['stages'][stage]['peak_bytes'] for r in previous if stage in r['stages']]
+        if not times:
+            continue
+
+        baseTime = float(np.median(times))
+        if result['time'] > baseTime * (1 + timeThreshold) and result['time'] - baseTime > MIN_TIME:
+            regressions.append('{} {}: {:.3f}s against {:.3f}s'.format(run['model'], stage, result['time'], baseTime))
+
+        basePeak = float(np.median(peaks))
+        if result['peak_bytes'] > basePeak * (1 + memoryThreshold):
+            regressions.append('{} {}: {} bytes against {:.0f} bytes'.format(run['model'], stage, result['peak_bytes'], basePeak))
+
+    return regressions
+
+
+
+
+
+
+
+
+if __name__ == '__main__':
+
+    #e.g. python benchmark.py cifar10 resnet --scale 4
+    parser = argparse.ArgumentParser(description='benchmarks every stage of the comparison tool on synthetic layers')
+    parser.add_argument('models', nargs='*', default=['cifar10'], choices=sorted(MODELS))
+    parser.add_argument('--scale', type=float, default=1, help='divide the number of channels of every layer by this')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each stage')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--history', default=HISTORY_FILE, help='json file the results are kept in')
+    parser.add_argument('--work-dir', default=None, help='keep the generated files in this directory')
+    parser.add_argument('--no-save', action='store_true', help='do not add this run to the history')
+    parser.add_argument('--time-threshold', type=float, default=TIME_THRESHOLD)
+    parser.add_argument('--memory-threshold', type=float, default=MEMORY_THRESHOLD)
+    args = parser.parse_args()
+
+    history = read_history(args.history)
+    regressions = []
+    for model in args.models:
+        workDir = None if args.work_dir is None else os.path.join(args.work_dir, model)
+        run = run_benchmarks(model, args.scale, args.repeat, args.stages, workDir)
+        regressions += check_regressions(run, history, args.time_threshold, args.memory_threshold)
+        if not args.no_save:
+            save_run(run, args.history)
+
+    for regression in regressions:
+        print('regression in ' + regression)
+    print('\n\n\ndone')
+    sys.exit(1 if regressions else 0)
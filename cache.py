@@ -0,0 +1,136 @@
+import os
+import hashlib
+import numpy as np
+from loader import load_source, expand_sources, is_binary
+
+
+
+
+#default location of the cache and the most it is allowed to hold before old entries are evicted
+CACHE_DIR = '.layer_cache/'
+MAX_CACHE_BYTES = 4 << 30
+
+
+
+
+'''
+    Description:
+        loads a layer output file through a persistent cache of parsed arrays. The first time a file is seen it is parsed
+        with load_source and saved as a .npy file in the cache directory; afterwards, as long as the file has not changed, the
+        saved array is memory mapped instead of parsing the text again.
+    Inputs:
+        fileName - string name of the file to load. Can also be a glob pattern or list of shards, see load_source, in
+                   which case the joined array is cached as one entry
+        cacheDir - directory holding the cached arrays. It is created if it does not exist.
+        dtype - numpy dtype of the returned array
+        useHash - if True the file contents are hashed as part of the key, so a file rewritten with the same size and
+                  modification time is still detected. Costs a full read of the file on every call.
+        maxBytes - size the cache is trimmed back down to, least recently used entries first, after a new entry is added
+    Outputs:
+        returns the array, memory mapped read only if it came from the cache
+'''
+def load_cached(fileName, cacheDir=CACHE_DIR, dtype=np.float32, useHash=False, maxBytes=MAX_CACHE_BYTES):
+
+    #binary dumps are memory mapped where they are, a parsed copy would gain nothing
+    if any(is_binary(name) for name in expand_sources(fileName)):
+        return load_source(fileName, dtype=dtype)
+
+    cachePath = os.path.join(cacheDir, cache_key(fileName, dtype, useHash) + '.npy')
+
+    #hit, mark the entry as recently used and map it
+    if os.path.exists(cachePath):
+        try:
+            arr = np.load(cachePath, mmap_mode='r')
+            os.utime(cachePath)
+            return arr
+        except (ValueError, OSError):
+            #another process may have evicted it already
+            try:
+                os.remove(cachePath)
+            except FileNotFoundError:
+                pass
+
+    #miss, parse the text file and store it. Written to a temporary name first so a crash never leaves half an entry.
+    #The temporary name does not end in .npy, so evict in another process never counts or removes it. np.save is given
+    #the open file because it would add .npy to a name
+    arr = load_source(fileName, dtype=dtype)
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpPath = cachePath + '.tmp' + str(os.getpid())
+    with open(tmpPath, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmpPath, cachePath)
+
+    evict(cacheDir, maxBytes, keep=cachePath)
+    return arr
+
+
+
+
+'''
+    Description:
+        builds the cache key of a file from its path, size, modification time and the dtype it is loaded as
+    Inputs:
+        fileName - string name of the file, or a glob pattern or list of shards. Their key covers every shard, so adding,
+                   removing or changing any of them changes it.
+        dtype - numpy dtype the file is loaded as
+        useHash - if True the sha1 of the file contents is included in the key as well
+    Outputs:
+        returns a string that is safe to use as a filename and changes whenever the file does
+'''
+def cache_key(fileName, dtype=np.float32, useHash=False):
+    paths = [os.path.abspath(name) for name in expand_sources(fileName)]
+
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        h.update('{}|{}|{}|{}'.format(path, st.st_size, st.st_mtime_ns, np.dtype(dtype).str).encode())
+        if useHash:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+
+    #keep the original name at the front so the cache directory can be browsed by hand
+    name = os.path.basename(paths[0])
+    if len(paths) > 1:
+        name += '+' + str(len(paths) - 1)
+    return name.replace('.', '_') + '-' + h.hexdigest()[:20]
+
+
+
+
+'''
+    Description:
+        removes the least recently used arrays from the cache until it fits in the given size
+    Inputs:
+        cacheDir - directory holding the cached arrays
+        maxBytes - size the cache is allowed to hold
+        keep - path of an entry that should never be removed, e.g. the one that was just written
+    Outputs:
+        does not return anything but entries may have been deleted from cacheDir
+'''
+def evict(cacheDir, maxBytes=MAX_CACHE_BYTES, keep=None):
+    entries = []
+    total = 0
+    for name in os.listdir(cacheDir):
+        if not name.endswith('.npy'):
+            continue
+        path = os.path.join(cacheDir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime_ns, st.st_size, path))
+        total += st.st_size
+
+    #oldest modification time first, which load_cached bumps on every hit
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= maxBytes:
+            break
+        if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
@@ -1,13 +1,31 @@
+import os
+import queue
+import shutil
+import threading
 import numpy as np
-import xlsxwriter
-from decimal import *
+from concurrent.futures import ProcessPoolExecutor
+from loader import load_source, expand_sources, iter_txt, iter_tokens, row_width
+from cache import load_cached
+from report import create_report, write_layer, write_tiles, write_fixed_layer, write_metrics
+from manifest import read_manifest, write_manifest, results_dir, layer_key, fingerprint, lookup_result, store_result, layer_stats
+from serializer import write_blob, write_binary_blob, write_weights_3d, write_weights_2d, write_fc_weights, write_bias
+from instrument import make_emitter, stage
+from tiles import WORST_CELLS
+from fixed import parse_format, format_name, lsb_diff, lsb_stats
+from metrics import layer_metrics, relative_difference, METRICS
+
+
+
+
+#size of the .npy header convert_to_2d writes, big enough for any shape
+NPY_HEADER_SIZE = 256
 
 
 
 
 '''
     Description: 
-        wrapper for the xlsxwriter workbook creation function so you dont have to remember it everytime
+        wrapper for the xlsxwriter workbook creation function so you dont have to remember it everytime. The workbook is opened in constant_memory mode, see report.create_report
     Inputs:
         name - string name of the excel file to be created
     Outputs: 
@@ -15,7 +33,7 @@ from decimal import *
 '''
 #creates the workbook that needs to be passed to compare_xlsxwriter (just a wrapper for an xlsxwriter function)
 def create_workbook(name):
-    return xlsxwriter.Workbook(name)
+    return create_report(name)
  
 
 
@@ -25,71 +43,195 @@ def create_workbook(name):
         compare blobs using xlsxwriter and save in excel file
     Inputs:
         workbook - an xlsxwriter workbook which is used to write the information to excel files
-        caffetxt - string name of file where the caffe layer's output is stored
-        cpptxt - string name of file where the cpp layer's output is stored
+        caffetxt - string name of file where the caffe layer's output is stored. Can be a raw [[[ ... ]]] dump, it does not need to be run through convert_to_2d first.
+        cpptxt - string name of file where the cpp layer's output is stored. Can also be a glob pattern or list of files when the output is split across several files, e.g. 'provided_vivado_files/conv1out*.txt'. They are read in order as one array, so they do not need to be merged with mergeFiles first.
         caffeSheetName - string of desired name for the caffe sheet in the excel file. Useful for differentiating multiple layers in a single file. If nothing is provided will default to Sheet1, Sheet2, etc.
         cppSheetName - string of desired name for the cpp sheet in the excel file. Useful for differentiating multiple layers in a single file. If nothing is provided will default to Sheet1, Sheet2, etc.
         errorSheetName - string of desired name for the error sheet in the excel file. Useful for differentiating multiple layers in a single file. If nothing is provided will default to Sheet1, Sheet2, etc.
+        cacheDir - optional directory to keep parsed copies of the text files in. Files that have not changed since the last run are memory mapped from there instead of being parsed again.
+        tileSizes - optional list of tile sizes, e.g. [8, 32]. If given, a tile sheet with the per channel and per tile statistics at each size and a worst sheet with the lowest similarities are written instead of every value (see report.write_tiles), which keeps the workbook small for large layers. The tile sheet is named after errorSheetName with 'tiles' in place of 'error'.
+        worst - number of lowest similarities written to the worst sheet when tileSizes is given
+        full - if True the caffe, cpp and error sheets with every value are written as well when tileSizes is given
+        fixed - optional fixed point format of the cpp network, e.g. 'ap_fixed<16,6,AP_RND,AP_SAT>' (see fixed.parse_format). If given, the caffe output is quantized to it bit exactly and the error sheet holds the difference of every value in LSBs instead of the relative similarity, with the fraction of exact values at the top (see report.write_fixed_layer). Can not be combined with tileSizes.
+        metrics - if True the layer_metrics of the layer (see metrics.py) are worked out from the arrays already loaded for the comparison and written to a metrics sheet, the whole layer on top and every channel below it (see report.write_metrics). The metrics sheet is named after errorSheetName with 'metrics' in place of 'error'.
+        useHash - if True the cache keys of cacheDir include a hash of the file contents, so a file rewritten with the same size and modification time is parsed again (see cache.cache_key). Only used with cacheDir.
     Outputs: 
         does not return anything, however the workbook provided is now filled populated with comparisons of the passed in information.
 '''
-def compare(workbook,caffetxt, cpptxt,caffeSheetName=None,cppSheetName=None,errorSheetName=None):
+def compare(workbook,caffetxt, cpptxt,caffeSheetName=None,cppSheetName=None,errorSheetName=None,cacheDir=None,tileSizes=None,worst=WORST_CELLS,full=False,fixed=None,metrics=False,useHash=False):
+
+    assert tileSizes is None or fixed is None
+    #the tiles and the channel metrics are worked out per channel, so the layer is kept in its tensor shape for them
+    keepShape = tileSizes is not None or metrics
+    caffe, cpp, error, ave_error, layerMetrics, events = _score_layer(caffetxt, cpptxt, cacheDir, keepShape=keepShape, fixed=fixed, metrics=metrics, useHash=useHash)
+
+    #write caffe, cpp and error sheets, and the tiled summary and metrics if asked for
+    _write_sheets(workbook, caffe, cpp, error, ave_error, caffeSheetName, cppSheetName, errorSheetName, tileSizes, worst, full, fixed=fixed, layerMetrics=layerMetrics)
+ 
+
+
+
+'''
+    Description: 
+        loads a pair of layer outputs and calculates their similarity without writing anything. This is the part of compare that can run in a worker process.
+    Inputs:
+        caffetxt - string name of file where the caffe layer's output is stored
+        cpptxt - string name of file where the cpp layer's output is stored
+        cacheDir - optional directory to keep parsed copies of the text files in, see compare
+    Outputs: 
+        returns (caffe, cpp, error, ave_error). The arrays are 1 or 2 dimensional and all have the same shape.
+'''
+def score(caffetxt, cpptxt, cacheDir=None):
+
+    caffe, cpp = load_pair(caffetxt, cpptxt, cacheDir)
+    error, ave_error = similarity(caffe, cpp)
+
+    return caffe, cpp, error, ave_error
+ 
+
+
+
+'''
+    Description: 
+        calculates the similarity of two layer outputs that are already in memory, 1 minus metrics.relative_difference of every value. This is the formula every comparison in this file uses.
+    Inputs:
+        caffe - array of the caffe layer's output
+        cpp - array of the cpp layer's output, same shape as caffe
+    Outputs: 
+        returns (error, ave_error), the similarity of every value and its average, in float64 whatever the type of the inputs
+'''
+def similarity(caffe, cpp):
 
-    #load text files into numpy arrays
-    caffe = np.loadtxt(caffetxt)
-    cpp = np.loadtxt(cpptxt)
-    assert (caffe.shape == cpp.shape)
-    
     #calculate error and average
-    error = 1 - np.nan_to_num( np.absolute(caffe-cpp)/( np.maximum(caffe,cpp) ) )
+    error = 1 - relative_difference(caffe, cpp)
     ave_error = np.average(error)
 
-    #create sheets to write to
-    caffeSheet = workbook.add_worksheet(caffeSheetName)
-    cppSheet = workbook.add_worksheet(cppSheetName)
-    errorSheet = workbook.add_worksheet(errorSheetName)
-
-    #create fills for error sheet
-    greenFill = workbook.add_format()
-    greenFill.set_bg_color('green')
-    redFill = workbook.add_format()
-    redFill.set_bg_color('red')
-
-    #write to caffe sheet
-    if len(caffe.shape) == 2:
-        for i in range(caffe.shape[0]):
-            for j in range(caffe.shape[1]):
-                caffeSheet.write(i+1, j, caffe[i][j])
-
-        #write to cpp sheet
-        for i in range(cpp.shape[0]):
-            for j in range(cpp.shape[1]):
-                cppSheet.write(i+1, j, cpp[i][j])
-
-        #write to error sheet while coloring cells accordingly
-        for i in range(error.shape[0]):
-            for j in range(error.shape[1]):
-                if error[i][j] > 0.85:
-                    errorSheet.write(i+1, j, error[i][j],greenFill)
-                else:
-                    errorSheet.write(i+1, j, error[i][j],redFill)
+    return error, ave_error
+ 
+
+
+
+'''
+    Description: 
+        loads a pair of layer outputs in the 2D layout they are written to the sheets in
+    Inputs:
+        caffetxt - string name of file where the caffe layer's output is stored
+        cpptxt - string name of file where the cpp layer's output is stored
+        cacheDir - optional directory to keep parsed copies of the text files in, see compare
+        keepShape - if True caffe keeps the tensor shape of its file, e.g. (channels, rows, cols), instead of being laid out in 2D
+        useHash - if True the cache keys include a hash of the file contents, see compare
+    Outputs: 
+        returns (caffe, cpp), arrays of the same shape, cpp in the layout of caffe
+'''
+def load_pair(caffetxt, cpptxt, cacheDir=None, keepShape=False, useHash=False):
+
+    #load text files into numpy arrays. float64 keeps the sheets and average identical to np.loadtxt
+    if cacheDir is None:
+        caffe = load_source(caffetxt, dtype=np.float64)
+        cpp = load_source(cpptxt, dtype=np.float64)
     else:
-        for i in range(caffe.shape[0]):
-            caffeSheet.write(i+1, 1, caffe[i])
+        caffe = load_cached(caffetxt, cacheDir, dtype=np.float64, useHash=useHash)
+        cpp = load_cached(cpptxt, cacheDir, dtype=np.float64, useHash=useHash)
+
+    #tensors from bracketed dumps are laid out as rows of their last dimension, the same as convert_to_2d.
+    #cpp outputs with another line layout, e.g. one value per line, are viewed in the caffe layout
+    if not keepShape:
+        caffe = to_2d(caffe)
+    assert (caffe.size == cpp.size)
+    cpp = cpp.reshape(caffe.shape)
+
+    return caffe, cpp
+ 
 
-        #write to cpp sheet
-        for i in range(cpp.shape[0]):
-            cppSheet.write(i+1, 1, cpp[i])
 
-        #write to error sheet while coloring cells accordingly
-        for i in range(error.shape[0]):
-            if error[i] > 0.85:
-                errorSheet.write(i+1, 1, error[i],greenFill)
-            else:
-                errorSheet.write(i+1, 1, error[i],redFill)
 
-    errorSheet.write('D1','Average : ')
-    errorSheet.write('E1',ave_error)
+'''
+    Description: 
+        compares two layer outputs that are already in memory and writes them to the workbook the same way compare does, without the round trip through text files.
+        Arrays and anything supporting the buffer protocol are used in place, e.g. net.blobs[name].data from a caffe net and the raw output buffer of a testbench.
+    Inputs:
+        workbook - an xlsxwriter workbook which is used to write the information to excel files
+        caffe - the caffe layer's output
+        cpp - the cpp layer's output. Only needs the same number of values as caffe, it is viewed in caffe's layout.
+        caffeSheetName - string of desired name for the caffe sheet in the excel file. If nothing is provided will default to Sheet1, Sheet2, etc.
+        cppSheetName - string of desired name for the cpp sheet in the excel file. If nothing is provided will default to Sheet1, Sheet2, etc.
+        errorSheetName - string of desired name for the error sheet in the excel file. If nothing is provided will default to Sheet1, Sheet2, etc.
+        dtype - type of the values in buffers that carry no type of their own, like bytes or bytearray
+    Outputs: 
+        returns ave_error, the average similarity that is written to the error sheet
+'''
+def compare_arrays(workbook,caffe,cpp,caffeSheetName=None,cppSheetName=None,errorSheetName=None,dtype=np.float32):
+
+    caffe, cpp, error, ave_error = score_arrays(caffe, cpp, dtype)
+
+    #write caffe, cpp and error sheets
+    write_layer(workbook, caffe, cpp, error, ave_error, caffeSheetName, cppSheetName, errorSheetName)
+
+    return ave_error
+ 
+
+
+
+'''
+    Description: 
+        the in memory version of score. Calculates the similarity of two layer outputs without copying or writing them.
+    Inputs:
+        caffe - the caffe layer's output, an array or buffer
+        cpp - the cpp layer's output, an array or buffer with the same number of values as caffe
+        dtype - type of the values in buffers that carry no type of their own, like bytes or bytearray
+    Outputs: 
+        returns (caffe, cpp, error, ave_error) like score. caffe and cpp are views of the inputs in the layout compare writes to the sheets: a leading batch dimension of 1 is dropped, so an fc blob of shape (1, N) is a column like its text dump, and tensors are rows of their last dimension. error and ave_error are float64 like compare's.
+'''
+def score_arrays(caffe, cpp, dtype=np.float32):
+
+    caffe = as_array(caffe, dtype)
+    if len(caffe.shape) > 1 and caffe.shape[0] == 1:
+        caffe = caffe[0]
+    caffe = to_2d(caffe)
+    cpp = as_array(cpp, dtype)
+    assert (caffe.size == cpp.size)
+    cpp = cpp.reshape(caffe.shape)
+
+    error, ave_error = similarity(caffe, cpp)
+
+    return caffe, cpp, error, ave_error
+ 
+
+
+
+'''
+    Description: 
+        views an array or buffer protocol object as a numpy array without copying it
+    Inputs:
+        buf - numpy array, or any object supporting the buffer protocol (memoryview, array.array, bytes, ...)
+        dtype - type of the values if buf is untyped bytes
+    Outputs: 
+        returns a numpy array sharing memory with buf
+'''
+def as_array(buf, dtype=np.float32):
+    if isinstance(buf, np.ndarray):
+        return buf
+
+    view = memoryview(buf)
+    if view.format in ('B', 'b', 'c') and np.dtype(dtype).itemsize != 1:
+        return np.frombuffer(view, dtype=dtype)
+    return np.asarray(view)
+ 
+
+
+
+'''
+    Description: 
+        lays a tensor out the way it is written to the sheets. Anything with more than 2 dimensions becomes rows of its last dimension, the same as convert_to_2d.
+    Inputs:
+        arr - numpy array
+    Outputs: 
+        returns a 1 or 2 dimensional view of arr
+'''
+def to_2d(arr):
+    if len(arr.shape) > 2:
+        return arr.reshape(-1, arr.shape[-1])
+    return arr
  
 
 
@@ -100,39 +242,336 @@ def compare(workbook,caffetxt, cpptxt,caffeSheetName=None,cppSheetName=None,erro
     Inputs:
         excelFileName - name of excel file to be created
         caffe_path - path to directory holding files of caffe layer's outputs. Assumes there is a file in the directory named filenames.txt that contains a list of all other files in the directory in order.
-        cpp_path  - path to directory holding files of cpp layer's outputs. Assumes there is a file in the directory named filenames.txt that contains a list of all other files in the directory in order.
+        cpp_path  - path to directory holding files of cpp layer's outputs. Assumes there is a file in the directory named filenames.txt that contains a list of all other files in the directory in order. A line can be a glob pattern like conv1out*.txt for a layer split across several files.
+        cacheDir - optional directory to keep parsed copies of the text files in, see compare
+        workers - number of processes used to load and score the layers. With more than 1, layers are scored in parallel while this process writes the sheets, still in the order of filenames.txt. At most workers layers are scored or waiting ahead of the one being written, so memory stays near that of a serial run.
+        incremental - if True a manifest of every layer's input fingerprints and results is kept next to the excel file (see manifest.py). Layers whose inputs have not changed since the last run are not compared again, their stored results are written to the new workbook instead. Parsed inputs are cached in the results directory next to the excel file unless cacheDir is given.
+        hooks - optional function, or list of functions, called with an event dict for every stage of every layer: 'load', 'error' (not for reused layers), 'caffe sheet', 'cpp sheet' and 'error sheet', 'metrics' and 'metrics sheet' when metrics is set, plus 'wait' for the time spent waiting on a worker when workers > 1, and a final 'close' for the workbook. Each event has the wall time, cpu time, bytes read and peak memory of the stage (see instrument.stage) and the layer's index, file and whether it was reused. Load and error are measured in the worker process that ran them.
+        logFile - optional name of a file every event is appended to as one line of json
+        tileSizes - optional list of tile sizes. If given, every layer gets a tiles and a worst sheet instead of its caffe, cpp and error sheets, see compare. They are written in the 'tile sheet' and 'worst sheet' stages.
+        worst - number of lowest similarities written to each worst sheet when tileSizes is given
+        full - if True the caffe, cpp and error sheets are written as well when tileSizes is given
+        fixed - optional fixed point format of the cpp network. If given, every layer is compared bit exactly in LSBs instead of by relative similarity, see compare. The format is part of the manifest key, so incremental runs never reuse results of another mode.
+        inFlight - if above 0 the layers are read in one background thread and scored in another while this thread writes the sheets, so reading layer N+1 overlaps with scoring and writing layer N. At most inFlight layers are held between being read and having their sheets written; the reader waits for a slot before reading the next one, so memory stays capped. 2 is the least that overlaps anything. Can not be combined with workers > 1. In this mode 'load' and 'error' are measured in their threads, so their cpu time and peak memory include whatever the other threads did meanwhile, and 'wait' is the time spent waiting on the threads.
+        metrics - if True every layer also gets a metrics sheet, see compare. The metrics are worked out where the layer is scored, in a worker or thread if there are any, from the arrays loaded for it. With incremental the whole layer metrics are kept in the manifest stats as well; reused layers have theirs worked out again from the arrays loaded for their sheets.
+        useHash - if True the cache keys of cacheDir, or of the inputs cached for incremental runs, include a hash of the file contents, see compare
     Outputs: 
         does not return anything but creates an excel file that holds all the comparisons    
 '''
 #given a filename to save comparisons in and path to two directories containing layer outputs for caffe and cpp networks, compares them and keeps comparisons in xlsxfile.
-def auto_compare(excelFileName,caffe_path,cpp_path):
+def auto_compare(excelFileName,caffe_path,cpp_path,cacheDir=None,workers=1,incremental=False,hooks=None,logFile=None,tileSizes=None,worst=WORST_CELLS,full=False,fixed=None,inFlight=0,metrics=False,useHash=False):
+
+    assert tileSizes is None or fixed is None
+    assert workers <= 1 or inFlight == 0
+    pairs = read_pairs(caffe_path, cpp_path)
+    if fixed is not None:
+        fixed = parse_format(fixed)
+
+    #the tiles and the channel metrics are worked out per channel, so the layers are kept in their tensor shape
+    keepShape = tileSizes is not None or metrics
+
+    #where the timing of every stage goes, if anywhere
+    log = None if logFile is None else open(logFile, 'a')
+    emit = make_emitter(hooks, log)
+
+    #find the layers that can be taken from the last run
+    reused = {}
+    if incremental:
+        manifest = read_manifest(excelFileName)
+        if cacheDir is None:
+            cacheDir = results_dir(excelFileName) + 'inputs' + os.sep
+        keys = [layer_key(pair[0], pair[1]) + ('' if fixed is None else '|' + format_name(fixed)) for pair in pairs]
+        prints = [fingerprint(pair[0], pair[1]) for pair in pairs]
+        for i in range(len(pairs)):
+            stored = lookup_result(manifest, excelFileName, keys[i], prints[i])
+            if stored is not None:
+                reused[i] = stored
+
+    #create excel file
+    workbook = create_workbook(excelFileName)
+
+    #score in worker processes. The results are collected in filenames.txt order so the sheets always come out in the same order.
+    #Only workers layers are submitted ahead of the one being written, so finished results do not pile up in memory
+    pool = None
+    pending = {}
+    queued = iter([i for i in range(len(pairs)) if i not in reused])
+    def submit_next():
+        i = next(queued, None)
+        if i is not None:
+            pending[i] = pool.submit(_score_layer, pairs[i][0], pairs[i][1], cacheDir, emit is not None, keepShape, fixed, metrics, useHash)
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        for _ in range(workers):
+            submit_next()
+
+    #or read and score in threads ahead of the sheets being written
+    pipeline = None
+    if inFlight > 0:
+        pipeline = _pipeline(pairs, reused, cacheDir, useHash, emit is not None, keepShape, fixed, metrics, inFlight)
+
+    #compare each file, or reuse its result, and write its sheets
+    try:
+        for i, (caffePath, cppPath, caffeSheetName, cppSheetName, errorSheetName) in enumerate(pairs):
+            print('beginning next file')
+            fields = {'layer': i, 'file': os.path.basename(caffePath), 'reused': i in reused}
+            if pipeline is not None:
+                with stage(emit, 'wait', **fields):
+                    caffe, cpp, error, ave_error, layerMetrics, events = next(pipeline)
+            elif i in reused:
+                with stage(emit, 'load', **fields):
+                    caffe, cpp = load_pair(caffePath, cppPath, cacheDir, keepShape, useHash)
+                events = []
+            elif i in pending:
+                with stage(emit, 'wait', **fields):
+                    caffe, cpp, error, ave_error, layerMetrics, events = pending.pop(i).result()
+                submit_next()
+            else:
+                caffe, cpp, error, ave_error, layerMetrics, events = _score_layer(caffePath, cppPath, cacheDir, emit is not None, keepShape, fixed, metrics, useHash)
+
+            if i in reused:
+                error, stats = reused[i]
+                error = error.reshape(caffe.shape)
+                ave_error = stats['ave_error']
+                layerMetrics = _layer_metrics(caffe, cpp, events.append if emit is not None else None, metrics)
+
+            #stages measured while scoring, possibly in a worker
+            for event in events:
+                event.update(fields)
+                emit(event)
+
+            if incremental and i not in reused:
+                if fixed is None:
+                    stats = layer_stats(error, ave_error)
+                else:
+                    #LSB differences are not similarities, so they get the counts of the LSB sheet instead of a threshold
+                    stats = dict(lsb_stats(error), ave_error=float(ave_error), count=int(error.size), shape=list(error.shape))
+                if layerMetrics is not None:
+                    stats['metrics'] = {key: float(layerMetrics[key]) for key in METRICS}
+                store_result(manifest, excelFileName, keys[i], prints[i], error, stats)
+
+            _write_sheets(workbook, caffe, cpp, error, ave_error, caffeSheetName, cppSheetName, errorSheetName,
+                          tileSizes, worst, full, lambda name: stage(emit, name, **fields), fixed, layerMetrics)
+            print(os.path.basename(caffePath) + (' reused' if i in reused else ' finished'))
+
+        with stage(emit, 'close'):
+            workbook.close()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if pipeline is not None:
+            pipeline.close()
+        if log is not None:
+            log.close()
+
+    if incremental:
+        write_manifest(excelFileName, manifest, keep=keys)
+ 
+
+
+
+#score, measuring its load, error and metrics stages when instrumented. It can run in a worker process, so the events are returned with the result rather than sent.
+#With a fixed point format the error is the LSB difference of every value and ave_error the fraction that match exactly. The layer_metrics are None unless asked for
+def _score_layer(caffetxt, cpptxt, cacheDir=None, instrumented=False, keepShape=False, fixed=None, metrics=False, useHash=False):
+    events = []
+    emit = events.append if instrumented else None
+
+    with stage(emit, 'load'):
+        caffe, cpp = load_pair(caffetxt, cpptxt, cacheDir, keepShape, useHash)
+    error, ave_error = _layer_error(caffe, cpp, emit, fixed)
+    layerMetrics = _layer_metrics(caffe, cpp, emit, metrics)
+
+    return caffe, cpp, error, ave_error, layerMetrics, events
+ 
+
+
+
+#the error stage of _score_layer
+def _layer_error(caffe, cpp, emit=None, fixed=None):
+    with stage(emit, 'error'):
+        if fixed is None:
+            return similarity(caffe, cpp)
+        error = lsb_diff(caffe, cpp, fixed)
+        return error, lsb_stats(error)['exact']
+ 
+
+
+
+#the metrics stage of _score_layer, None unless metrics are asked for
+def _layer_metrics(caffe, cpp, emit=None, metrics=False):
+    if not metrics:
+        return None
+    with stage(emit, 'metrics'):
+        return layer_metrics(caffe, cpp)
+ 
+
+
+
+#yields (caffe, cpp, error, ave_error, layerMetrics, events) of every layer in order, read by one thread and scored by another,
+#with at most inFlight layers between being read and handed on. A layer's slot is freed when the next one is asked for, after
+#its sheets are written. Reused layers are only read, their error, ave_error and layerMetrics are None. An exception in either
+#thread is raised here. Closing the generator stops both threads
+def _pipeline(pairs, reused, cacheDir, useHash, instrumented, keepShape, fixed, metrics, inFlight):
+    slots = threading.Semaphore(inFlight)
+    stop = threading.Event()
+    loaded = queue.Queue(inFlight)
+    scored = queue.Queue(inFlight)
+    threads = [threading.Thread(target=_read_stage, args=(pairs, cacheDir, useHash, instrumented, keepShape, slots, loaded, stop), daemon=True),
+               threading.Thread(target=_error_stage, args=(len(pairs), reused, instrumented, fixed, metrics, loaded, scored, stop), daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for _ in range(len(pairs)):
+            item = scored.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            slots.release()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+ 
+
+
+
+#reads the layers in order for _pipeline, each once a slot is free
+def _read_stage(pairs, cacheDir, useHash, instrumented, keepShape, slots, loaded, stop):
+    try:
+        for caffePath, cppPath, _, _, _ in pairs:
+            while not slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            events = []
+            with stage(events.append if instrumented else None, 'load'):
+                caffe, cpp = load_pair(caffePath, cppPath, cacheDir, keepShape, useHash)
+            if not _put(loaded, (caffe, cpp, events), stop):
+                return
+    except Exception as e:
+        _put(loaded, e, stop)
+ 
+
+
+
+#scores the layers _read_stage hands on, except reused ones
+def _error_stage(count, reused, instrumented, fixed, metrics, loaded, scored, stop):
+    try:
+        for i in range(count):
+            item = _get(loaded, stop)
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                _put(scored, item, stop)
+                return
+
+            caffe, cpp, events = item
+            error = ave_error = layerMetrics = None
+            if i not in reused:
+                error, ave_error = _layer_error(caffe, cpp, events.append if instrumented else None, fixed)
+                layerMetrics = _layer_metrics(caffe, cpp, events.append if instrumented else None, metrics)
+            if not _put(scored, (caffe, cpp, error, ave_error, layerMetrics, events), stop):
+                return
+    except Exception as e:
+        _put(scored, e, stop)
+ 
+
+
+
+#puts an item on a queue unless stop is set while waiting for room. Returns whether it was put
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+ 
+
+
+
+#takes an item off a queue, or None if stop is set while waiting for one
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+ 
+
+
+
+#writes the sheets of one layer: every value unless only the tiled summary is wanted, the tiled summary if tile sizes are given
+#and the metrics if there are any. The tiles, worst and metrics sheets are named after the error sheet. Fixed point comparisons
+#get an LSB sheet in place of the error sheet
+def _write_sheets(workbook, caffe, cpp, error, ave_error, caffeSheetName, cppSheetName, errorSheetName, tileSizes=None, worst=WORST_CELLS, full=False, record=None, fixed=None, layerMetrics=None):
+    if fixed is not None:
+        lsbSheetName = None if errorSheetName is None else errorSheetName.replace('error', 'lsb')
+        write_fixed_layer(workbook, to_2d(caffe), to_2d(cpp), to_2d(error), caffeSheetName, cppSheetName, lsbSheetName, record)
+
+    elif tileSizes is None or full:
+        write_layer(workbook, to_2d(caffe), to_2d(cpp), to_2d(error), ave_error, caffeSheetName, cppSheetName, errorSheetName, record)
+
+    if tileSizes is not None:
+        tileSheetName = worstSheetName = None
+        if errorSheetName is not None:
+            tileSheetName = errorSheetName.replace('error', 'tiles') if 'error' in errorSheetName else errorSheetName + ' tiles'
+            worstSheetName = errorSheetName.replace('error', 'worst') if 'error' in errorSheetName else errorSheetName + ' worst'
+        write_tiles(workbook, caffe, cpp, error, ave_error, tileSheetName, worstSheetName, tileSizes, worst, record)
+
+    if layerMetrics is not None:
+        metricsSheetName = None
+        if errorSheetName is not None:
+            metricsSheetName = errorSheetName.replace('error', 'metrics') if 'error' in errorSheetName else errorSheetName + ' metrics'
+        write_metrics(workbook, layerMetrics, metricsSheetName, record)
+ 
+
+
+
+'''  
+    Description: 
+        reads the filenames.txt of two directories and pairs up the layers to compare
+    Inputs:
+        caffe_path - path to directory holding files of caffe layer's outputs, with a filenames.txt listing them in order
+        cpp_path  - path to directory holding files of cpp layer's outputs, with a filenames.txt listing them in the same order
+    Outputs: 
+        returns a list of (caffePath, cppPath, caffeSheetName, cppSheetName, errorSheetName) tuples, one per layer
+'''
+def read_pairs(caffe_path, cpp_path):
 
     #open files and read in both lists of files to compare
-    caffe_f = open(caffe_path + 'filenames.txt','r')
-    cpp_f = open(cpp_path + 'filenames.txt','r')
-    caffe_lines = caffe_f.readlines()
-    cpp_lines = cpp_f.readlines()
+    with open(caffe_path + 'filenames.txt','r') as caffe_f:
+        caffe_lines = caffe_f.readlines()
+    with open(cpp_path + 'filenames.txt','r') as cpp_f:
+        cpp_lines = cpp_f.readlines()
 
     #ensure you have the same number of files to compare in both arrays
     assert len(caffe_lines) == len(cpp_lines)
-    num_files = len(caffe_lines)
-
-    #create excel file
-    workbook = xlsxwriter.Workbook(excelFileName)
 
-    #compare each file by calling compare function
-    for i in range(num_files):
-        print('beginning next file')
+    pairs = []
+    for i in range(len(caffe_lines)):
         caffeFileName = caffe_lines[i].replace('\n','')
         cppFileName = cpp_lines[i].replace('\n','')
+        pairs.append((caffe_path + caffeFileName, cpp_path + cppFileName, sheet_name('caffe_'+caffeFileName[:-4]), sheet_name('vivado_'+cppFileName[:-4]), 'error ' + str(i)))
+
+    return pairs
+ 
 
-        caffePath = caffe_path + caffeFileName
-        cppPath = cpp_path + cppFileName
 
-        compare(workbook, caffePath, cppPath, caffeSheetName='caffe_'+caffeFileName[:-4], cppSheetName='vivado_'+cppFileName[:-4], errorSheetName='error ' + str(i))
-        print(caffeFileName + ' finished')
 
-    workbook.close()
+'''  
+    Description: 
+        makes a file name usable as a sheet name. Glob patterns from filenames.txt contain characters excel does not allow.
+    Inputs:
+        name - the wanted sheet name
+    Outputs: 
+        returns name with []:*?/\\ replaced by _
+'''
+def sheet_name(name):
+    for c in '[]:*?/\\':
+        name = name.replace(c, '_')
+    return name
  
 
 
@@ -146,11 +585,12 @@ def auto_compare(excelFileName,caffe_path,cpp_path):
         weights_directory - directory to save weight files
         bias_directory - directory to save bias files
         dimensions - string, either '3d' or '2d' determines whether 4 dimensional weights will be save as 2 dimensional arrays or 1 large 3 dimensional array
+        binary - optional, 'npy' or 'raw' to write the blobs as binary files (blob.npy, or blob.bin with a '#raw' header line, see loader.load_binary) in their tensor shape instead of 2D text. compare and auto_compare memory map them. The weights and biases are still written as cpp arrays.
     Outputs:
         does not return anything but weights biases and blobs are stored in files in their respective directory.
 '''
 # should write weights and biases in cpp format 
-def write_caffe_files(net, blobs_directory, weights_directory, bias_directory,dimensions='3d'):
+def write_caffe_files(net, blobs_directory, weights_directory, bias_directory,dimensions='3d',binary=None):
     
 
     #open file to keep track of filenames
@@ -161,47 +601,31 @@ def write_caffe_files(net, blobs_directory, weights_directory, bias_directory,di
     #iterate through all blobs
     for blob in net.blobs:
 
-        #save current blobs filename to make reading files later easier
-        f.write(blob + '_blob.txt\n')
-
         #get current blobs data
         W = net.blobs[blob].data[...]
 
-        #open file to store current blobs data
+        #binary blobs are written as they are, listed under the name they are saved as
+        if binary is not None:
+            blobFile = blob + ('.npy' if binary == 'npy' else '.bin')
+            f.write(blobFile + '\n')
+            with open(blobs_directory + blobFile, 'wb') as out_file:
+                write_binary_blob(out_file, W, binary)
+            print('done with ', blob,' blob')
+            continue
+
+        #save current blobs filename to make reading files later easier
+        f.write(blob + '_blob.txt\n')
+
+        #open file to store current blobs data. 4 dimensional (e.g. conv, norm, etc.) and 2 dimensional (e.g. fc) blobs are written in 2D form
         blobs_path = blobs_directory + blob + '.txt'
         with open(blobs_path, "w") as out_file:
-
-            #iterate through all layers that output size 4 (e.g. conv, norm, etc.)
-            if(len(W.shape) == 4):
-
-                #iterate through blob and create strings to write to file in 2D form
-                for i in range(len(W)):
-                    for j in range(len(W[i])):
-                        for k in range(len(W[i][j])):
-                            outstring = "  "
-                            for l in range(len(W[i][j][k])):
-                                outstring += "{:.8E}".format(Decimal(str(W[i][j][k][l]))) #
-                                outstring += "  "
-                            outstring += "\n"
-                            out_file.write(outstring)
-            #iterate through all layers that output size 2 (e.g. fc)
-            elif (len(W.shape) == 2):
-
-                #iterate through blob and create strings to write to file in 2D form
-                for i in range(len(W[0])):
-                    outstring = "  "
-                    for j in range(len(W)):
-                        outstring += "{:.8E}".format(Decimal(str(W[j][i]))) #
-                        outstring += "  "
-                    outstring += "\n"
-                    out_file.write(outstring)
+            write_blob(out_file, W)
 
             #reports when done with entire blob before file is closed
             print('done with ', blob,' blob')
     
     #closes file containing each blobs txt file name
     f.close()
-    #'''
 
     #open new files to hold names of weights and bias files
     f_w = open(weights_directory + 'weights_filenames.txt', 'w')
@@ -219,95 +643,22 @@ def write_caffe_files(net, blobs_directory, weights_directory, bias_directory,di
         B = net.params[params][1].data[...]
 
         ############################################################################################################################ WEIGHTS
-        #save weights in 3 dimensional arrays (c++ format) if selected
-        if dimensions == '3d':
+        if dimensions == '3d' or dimensions == '2d':
 
             #open file to store current filenames for each weight
             weights_path = weights_directory + params + '_weights.txt'
             with open(weights_path, "w") as out_file:
 
-                if(len(W.shape) == 4):  #iterate through all layers that have 4 dimensional weights 4 (e.g. conv)
-
-                    #iterate through blob and create strings to write to file in 3D form
-                    outstring = "{"
-                    for i in range(len(W)):
-                        for j in range(len(W[i])):
-                            outstring += "{"
-                            for k in range(len(W[i][j])):
-                                outstring += "{"
-                                outstring += "{:.8E}".format(Decimal(str(W[i][j][k][0]))) #
-                                for l in range(1,len(W[i][j][k])):
-                                    outstring += ", "
-                                    outstring += "{:.8E}".format(Decimal(str(W[i][j][k][l]))) #
-                                outstring += "},\n"
-                            outstring = outstring[:-2]
-                            outstring += "},\n\n"
-                    outstring = outstring[:-3]
-                    outstring += "};"
-                    out_file.write(outstring)
-                elif (len(W.shape) == 2):   #iterate through all layers that have 2 dimensional weights (e.g. fc)
-                    #TODO: ADD comments
-                    length = len(W)
-                    curr_end = 1024
-                    curr = 0
-                    while curr < length:
+                if(len(W.shape) == 4):  #layers that have 4 dimensional weights (e.g. conv)
 
-                        if curr_end > length:
-                            curr_end = length
+                    #save weights in 3 dimensional arrays (c++ format) or one 2 dimensional array per kernel and channel
+                    if dimensions == '3d':
+                        write_weights_3d(out_file, W)
+                    else:
+                        write_weights_2d(out_file, W)
 
-                        count = 0
-                        fcFile = params + '_weights_('+ str(curr) + '-' + str(curr_end) +').txt'
-                        f_curr = open(weights_directory + fcFile,'w')
-                        outstring = "{"
-                        for i in range(curr,curr_end):
-                            outstring += "{"
-                            outstring += "{:.8E}".format(Decimal(str(W[i][0]))) 
-                            count=1
-                            for j in range(1,len(W[i])):
-                                outstring += ", "
-                                if count == 8:
-                                    outstring+='\n'
-                                    count = 0
-                                outstring += "{:.8E}".format(Decimal(str(W[i][j]))) #
-
-                                count+=1
-                            outstring += "},\n"
-                        outstring = outstring[:-2]
-                        outstring += "};\n\n"
-
-                        f_curr.write(outstring)
-                        out_file.write(fcFile + '\n')
-
-                        curr = curr_end
-                        curr_end += 1024
-
-        #save weights in 2 dimensional arrays (c++ format) if selected
-        elif dimensions == '2d':
-            
-            #open file to store current filenames for each weight
-            weights_path = weights_directory + params + '_weights.txt'
-            with open(weights_path, "w") as out_file:
+                elif (len(W.shape) == 2):   #layers that have 2 dimensional weights (e.g. fc), split into files of 1024 rows
 
-                if(len(W.shape) == 4):  #iterate through all layers that have 4 dimensional weights 4 (e.g. conv)
-
-                    #iterate through blob and create strings to write to file in 2D form
-                    for i in range(len(W)):
-                        for j in range(len(W[i])):
-                            outstring = "kernel {}/{} channel {}/{}\n".format(i+1,len(W),j+1,len(W[i]))
-                            out_file.write(outstring)
-                            outstring = "{"
-                            for k in range(len(W[i][j])):
-                                outstring += "{"
-                                outstring += "{:.8E}".format(Decimal(str(W[i][j][k][0]))) #
-                                for l in range(1,len(W[i][j][k])):
-                                    outstring += ", "
-                                    outstring += "{:.8E}".format(Decimal(str(W[i][j][k][l]))) #
-                                outstring += "},\n"
-                            outstring = outstring[:-2]
-                            outstring += "};\n\n"
-                            out_file.write(outstring)
-                elif (len(W.shape) == 2):   #iterate through all layers that have 2 dimensional weights (e.g. fc)
-                    
                     length = len(W)
                     curr_end = 1024
                     curr = 0
@@ -316,27 +667,9 @@ def write_caffe_files(net, blobs_directory, weights_directory, bias_directory,di
                         if curr_end > length:
                             curr_end = length
 
-                        count = 0
                         fcFile = params + '_weights_('+ str(curr) + '-' + str(curr_end) +').txt'
-                        f_curr = open(weights_directory + fcFile,'w')
-                        outstring = "{"
-                        for i in range(curr,curr_end):
-                            outstring += "{"
-                            outstring += "{:.8E}".format(Decimal(str(W[i][0]))) 
-                            count=1
-                            for j in range(1,len(W[i])):
-                                outstring += ", "
-                                if count == 8:
-                                    outstring+='\n'
-                                    count = 0
-                                outstring += "{:.8E}".format(Decimal(str(W[i][j]))) #
-
-                                count+=1
-                            outstring += "},\n"
-                        outstring = outstring[:-2]
-                        outstring += "};\n\n"
-
-                        f_curr.write(outstring)
+                        with open(weights_directory + fcFile,'w') as f_curr:
+                            write_fc_weights(f_curr, W[curr:curr_end])
                         out_file.write(fcFile + '\n')
 
                         curr = curr_end
@@ -352,19 +685,10 @@ def write_caffe_files(net, blobs_directory, weights_directory, bias_directory,di
         #open file to store current filenames for each bias
         bias_path = bias_directory + params + '_bias.txt'
         with open(bias_path, "w") as out_file:
-
-            #iterate through current layer's bias and create string to write to file
-            outstring = "{ "
-            outstring += "{:.8E}".format(Decimal(str(B[0])))
-            for i in range(1,len(B)):
-                outstring += ",\n "
-                outstring += "{:.8E}".format(Decimal(str(B[i])))
-            outstring += ' };'
-            out_file.write(outstring)
+            write_bias(out_file, B)
         
             #report when completed with current layer's bias
             print('done with ', params,' bias')  
-        #'''
 
     #close files that were used to store filenames for weights and biases
     f_w.close()
@@ -375,53 +699,107 @@ def write_caffe_files(net, blobs_directory, weights_directory, bias_directory,di
 
 '''
     Description: 
-        converts input file to a common 2D format for comparisons.
+        converts input file to a common 2D format for comparisons. The file is streamed a chunk at a time and written in large blocks, so memory use does not grow with the file.
     Inputs:
         oldFile - file containing the original data tensor that is to be converted
         newFile - name of the new file that will contain the data in 2D format
-        numCols - number of columns per row. When comparing, you need the same shape.
+        numCols - number of columns per row. When comparing, you need the same shape. If nothing is provided it is worked out from the brackets of oldFile: the length of the innermost lists, or 1 for a plain [ ... ] list.
+        binary - if True newFile is written as a .npy array of dtype instead of text, with shape (rows, numCols) if numCols is given and the tensor shape from the brackets otherwise
+        dtype - type of the values in the binary file
     Outputs:
         returns nothing but a file containing the data in 2D format has been created.
 '''
-def convert_to_2d(oldFile,newFile,numCols):
-    f = open(oldFile,'r')
-    content = f.read()
-    content = content.replace('[','')
-    content = content.replace(']','')
-    content = content.replace(',','')
-    content = content.replace('\n',' ')
-    nums = content.split()
-
-    f1 = open(newFile,'w')
-    for i in range(1,len(nums)+1):
-        f1.write( '{:20}'.format(nums[i-1] + ''))
-        if i % numCols == 0:
-            f1.write('\n')
-
-    f1.close()
-    f.close()
+def convert_to_2d(oldFile,newFile,numCols=None,binary=False,dtype=np.float32):
+
+    if binary:
+        _convert_to_npy(oldFile, newFile, numCols, dtype)
+        return
+
+    if numCols is None:
+        numCols = row_width(oldFile)
+
+    #each value is padded to 20 characters with a line break after every numCols values, as it always has been
+    with open(newFile,'w') as f1:
+        count = 0
+        for tokens in iter_tokens(oldFile):
+            padded = [tok.ljust(20) for tok in tokens]
+            pieces = []
+
+            #finish the line the last chunk stopped in, then whole lines
+            start = 0
+            end = numCols - count % numCols
+            while start < len(padded):
+                pieces.append(''.join(padded[start:end]))
+                if end <= len(padded):
+                    pieces.append('\n')
+                start, end = end, end + numCols
+            f1.write(''.join(pieces))
+            count += len(padded)
+ 
+
+
+
+#writes the values of a text file to a .npy file as they are parsed. The header is written with room to spare and filled in once the shape is known
+def _convert_to_npy(oldFile, newFile, numCols, dtype):
+    info = {}
+    count = 0
+    with open(newFile, 'wb') as f:
+        f.write(_npy_header(dtype, (0,)))
+        for nums in iter_txt(oldFile, dtype, info=info):
+            f.write(nums.astype(np.dtype(dtype).newbyteorder('<'), copy=False).tobytes())
+            count += len(nums)
+
+        shape = info['shape'] if numCols is None else (count // numCols, numCols)
+        assert int(np.prod(shape)) == count
+        f.seek(0)
+        f.write(_npy_header(dtype, shape))
+
+
+
+
+#fixed size version 1.0 .npy header, so it can be rewritten in place
+def _npy_header(dtype, shape):
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(np.dtype(dtype).newbyteorder('<').str, repr(tuple(shape)))
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    assert len(header) == NPY_HEADER_SIZE - 10
+    return b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1')
  
 
 
 
 '''
     Description: 
-        merges files. Used to merge outputs of layers that have been seperated across seperate files
+        merges files. Used to merge outputs of layers that have been seperated across seperate files. compare and auto_compare can read the separate files directly, so this is only needed when a merged file is wanted for something else.
+        The data is copied by the kernel (os.copy_file_range) where possible, without passing through python.
     Inputs:
-        fileList - a list containing all the filenames to merge
+        fileList - a list containing all the filenames to merge. Can also contain glob patterns, see loader.load_source
         newFile - name of the to be created containing the merged data
     Outputs:
         does not return anything but a file is created containing all the data from the list of files
 '''
 def mergeFiles(fileList,newFile):
-    f = open(newFile,'w')
+    with open(newFile,'wb') as f:
+        for fileName in expand_sources(fileList):
+            with open(fileName,'rb') as f1:
+                _copy_file(f1, f)
 
-    for i in range(len(fileList)):
-        f1 = open(fileList[i],'r')
-        f.write( f1.read() )
 
-    f.close()
-    f1.close()
+
+
+#copies the rest of one open file to another, in the kernel if the platform supports it
+def _copy_file(src, dst):
+    copy_range = getattr(os, 'copy_file_range', None)
+    if copy_range is not None:
+        dst.flush()
+        try:
+            while copy_range(src.fileno(), dst.fileno(), 1 << 30) > 0:
+                pass
+            return
+        except OSError:
+            #not supported between these files, copy what is left normally
+            src.seek(os.lseek(src.fileno(), 0, os.SEEK_CUR))
+            dst.seek(os.lseek(dst.fileno(), 0, os.SEEK_CUR))
+    shutil.copyfileobj(src, dst, 1 << 20)
 
 
 
@@ -440,7 +818,7 @@ if __name__ == '__main__':
     #convert from c++ array format to 2d arrays
     #       FIRST PARAMETER IS NAME/LOCATION OF OLD FILE
     #       SECOND PARAMETER IS NAME/LOCATION OF NEW FILE THAT WILL BE CREATED
-    #       THIRD PARAMETER IS NUMBER OF COLUMNS TO HAVE
+    #       THIRD PARAMETER IS NUMBER OF COLUMNS TO HAVE. OPTIONAL, IF LEFT OUT IT IS WORKED OUT FROM THE BRACKETS IN THE OLD FILE
     '''                 #format
     convert_to_2d('provided_caffe_files/cifar10_conv1.txt','generated_caffe_files/conv1.txt',31)
     convert_to_2d('provided_caffe_files/cifar10_conv2.txt','generated_caffe_files/conv2.txt',31)
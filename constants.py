@@ -0,0 +1,7 @@
+#similarities above this are colored green on the error sheet and everything at or below it red. Every check that counts
+#values, channels, tiles, layers or images as failing uses it as its default cutoff
+THRESHOLD = 0.85
+
+#number of values the block by block loops work on at a time. Big enough that numpy's per call overhead does not matter
+#and small enough that the temporaries of a block stay a few megabytes
+BLOCK_SIZE = 1 << 20
@@ -0,0 +1,183 @@
+import re
+import numpy as np
+from constants import BLOCK_SIZE
+
+
+
+
+#quantization and overflow modes of ap_fixed that are emulated, the defaults it uses when none are given first. AP_WRAP_SM
+#and a non-zero number of saturation bits are not supported
+ROUNDING_MODES = ['AP_TRN', 'AP_TRN_ZERO', 'AP_RND', 'AP_RND_ZERO', 'AP_RND_MIN_INF', 'AP_RND_INF', 'AP_RND_CONV']
+OVERFLOW_MODES = ['AP_WRAP', 'AP_SAT', 'AP_SAT_ZERO', 'AP_SAT_SYM']
+
+#largest absolute LSB difference counted on its own in the histogram, bigger ones share the last bin
+MAX_HISTOGRAM_LSB = 4
+
+
+
+
+'''
+    Description:
+        reads a fixed point format the way it is written in the c++ source
+    Inputs:
+        spec - a string like 'ap_fixed<16,6>', 'ap_fixed<16,6,AP_RND,AP_SAT>' or 'ap_ufixed<8,2>', a (width, intBits)
+               tuple, or a dict already returned by this function. A fifth template argument, the number of saturation
+               bits, can only be 0.
+    Outputs:
+        returns a dict with width, int_bits, signed, rounding and overflow. Raises ValueError for a format that can not
+        be emulated bit exactly.
+'''
+def parse_format(spec):
+    if isinstance(spec, dict):
+        return spec
+    if isinstance(spec, (tuple, list)):
+        fmt = {'width': int(spec[0]), 'int_bits': int(spec[1]), 'signed': True, 'rounding': 'AP_TRN', 'overflow': 'AP_WRAP'}
+    else:
+        match = re.match(r'\s*ap_(u?)fixed\s*<([^>]*)>\s*$', spec)
+        if match is None:
+            raise ValueError('not an ap_fixed type: ' + spec)
+        args = [arg.strip() for arg in match.group(2).split(',')]
+        if len(args) > 5 or (len(args) == 5 and int(args[4]) != 0):
+            raise ValueError('only 0 saturation bits are supported: ' + spec)
+        fmt = {'width': int(args[0]),
+               'int_bits': int(args[1]),
+               'signed': match.group(1) == '',
+               'rounding': args[2] if len(args) > 2 else 'AP_TRN',
+               'overflow': args[3] if len(args) > 3 else 'AP_WRAP'}
+
+    if fmt['rounding'] not in ROUNDING_MODES or fmt['overflow'] not in OVERFLOW_MODES:
+        raise ValueError('unsupported modes in ' + format_name(fmt))
+    assert 1 <= fmt['width'] <= 52
+    return fmt
+
+
+
+
+#the c++ type of a format, e.g. ap_fixed<16,6,AP_RND,AP_SAT>
+def format_name(fmt):
+    return '{}<{},{},{},{}>'.format('ap_fixed' if fmt['signed'] else 'ap_ufixed', fmt['width'], fmt['int_bits'], fmt['rounding'], fmt['overflow'])
+
+
+
+
+'''
+    Description:
+        quantizes values to a fixed point format bit exactly the way assigning them to an ap_fixed does, in one vectorized
+        pass. The values are scaled by a power of two, which is exact in float64, and the rounding and overflow are decided
+        on the exact integer and fraction parts, so there is no double rounding.
+    Inputs:
+        x - array of real values, e.g. the caffe reference
+        fmt - format from parse_format, or anything it accepts
+    Outputs:
+        returns an int64 array of the raw integer codes, value = code * 2**-(width - int_bits). nan quantizes to 0.
+'''
+def quantize(x, fmt):
+    fmt = parse_format(fmt)
+    width = fmt['width']
+    scaled = np.ldexp(np.asarray(x, dtype=np.float64), width - fmt['int_bits'])
+    scaled = np.nan_to_num(scaled, nan=0.0, posinf=2.0 ** 62, neginf=-2.0 ** 62)
+
+    #integer part and the exact fraction left over, 0 <= frac < 1
+    low = np.floor(scaled)
+    frac = scaled - low
+    rounding = fmt['rounding']
+    if rounding == 'AP_TRN':
+        up = np.zeros(frac.shape, dtype=bool)
+    elif rounding == 'AP_TRN_ZERO':
+        up = (frac > 0) & (scaled < 0)
+    elif rounding == 'AP_RND':
+        up = frac >= 0.5
+    elif rounding == 'AP_RND_ZERO':
+        up = (frac > 0.5) | ((frac == 0.5) & (scaled < 0))
+    elif rounding == 'AP_RND_MIN_INF':
+        up = frac > 0.5
+    elif rounding == 'AP_RND_INF':
+        up = (frac > 0.5) | ((frac == 0.5) & (scaled > 0))
+    else:
+        up = (frac > 0.5) | ((frac == 0.5) & (np.mod(low, 2) == 1))
+    q = low + up
+
+    #overflow, still in float64 where every integer involved is exact
+    if fmt['signed']:
+        lo, hi = -2.0 ** (width - 1), 2.0 ** (width - 1) - 1
+    else:
+        lo, hi = 0.0, 2.0 ** width - 1
+    overflow = fmt['overflow']
+    if overflow == 'AP_WRAP':
+        q = np.mod(q - lo, 2.0 ** width) + lo
+    elif overflow == 'AP_SAT':
+        q = np.clip(q, lo, hi)
+    elif overflow == 'AP_SAT_ZERO':
+        q = np.where((q < lo) | (q > hi), 0.0, q)
+    else:
+        q = np.where(q > hi, hi, np.where(q < lo, -hi if fmt['signed'] else lo, q))
+    return q.astype(np.int64)
+
+
+
+
+'''
+    Description:
+        turns values that already are in a fixed point format, like the cpp outputs, back into their integer codes. Text
+        dumps written with 6 decimals, as the testbench does, round trip exactly for up to 19 fractional bits.
+    Inputs:
+        x - array of real values
+        fmt - format from parse_format, or anything it accepts
+    Outputs:
+        returns an int64 array of the nearest integer codes
+'''
+def to_codes(x, fmt):
+    fmt = parse_format(fmt)
+    return np.rint(np.ldexp(np.nan_to_num(np.asarray(x, dtype=np.float64)), fmt['width'] - fmt['int_bits'])).astype(np.int64)
+
+
+
+
+'''
+    Description:
+        compares a cpp fixed point output with the caffe reference quantized to the same format, in units of the last place
+        of the format, a block of values at a time
+    Inputs:
+        caffe - array of the caffe layer's output
+        cpp - array of the cpp layer's output, with the same number of values
+        fmt - format from parse_format, or anything it accepts
+    Outputs:
+        returns an int64 array in the shape of caffe, cpp's code minus the quantized caffe code of every value
+'''
+def lsb_diff(caffe, cpp, fmt):
+    fmt = parse_format(fmt)
+    assert caffe.size == cpp.size
+    flatCaffe = caffe.reshape(-1)
+    flatCpp = cpp.reshape(-1)
+
+    out = np.empty(flatCaffe.size, dtype=np.int64)
+    for start in range(0, flatCaffe.size, BLOCK_SIZE):
+        end = start + BLOCK_SIZE
+        np.subtract(to_codes(flatCpp[start:end], fmt), quantize(flatCaffe[start:end], fmt), out=out[start:end])
+    return out.reshape(caffe.shape)
+
+
+
+
+'''
+    Description:
+        summary of the LSB differences of a layer
+    Inputs:
+        lsb - int64 array from lsb_diff
+    Outputs:
+        returns a dict of plain python numbers
+            exact - fraction of values that match bit for bit
+            mismatches - number of values that differ
+            max_lsb, mean_lsb - largest and mean absolute difference in LSBs
+            histogram - number of values at each absolute difference from 0 to MAX_HISTOGRAM_LSB, the last bin holding
+                        everything larger
+'''
+def lsb_stats(lsb):
+    diff = np.abs(lsb.reshape(-1))
+    count = diff.size
+    histogram = np.bincount(np.minimum(diff, MAX_HISTOGRAM_LSB), minlength=MAX_HISTOGRAM_LSB + 1)
+    return {'exact': float(histogram[0] / count) if count else 1.0,
+            'mismatches': int(count - histogram[0]),
+            'max_lsb': int(diff.max()) if count else 0,
+            'mean_lsb': float(diff.mean()) if count else 0.0,
+            'histogram': histogram.tolist()}
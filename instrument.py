@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+
+
+'''
+    Description:
+        builds the function events are sent to from the hooks and log file given to auto_compare
+    Inputs:
+        hooks - a function or list of functions that are called with every event dict
+        logFile - optional file object every event is written to as one line of json
+    Outputs:
+        returns a function taking an event dict, or None if there is nothing to send events to so nothing needs measuring
+'''
+def make_emitter(hooks=None, logFile=None):
+    if hooks is None:
+        hooks = []
+    elif callable(hooks):
+        hooks = [hooks]
+    if not hooks and logFile is None:
+        return None
+
+    def emit(event):
+        for hook in hooks:
+            hook(event)
+        if logFile is not None:
+            logFile.write(json.dumps(event) + '\n')
+            logFile.flush()
+    return emit
+
+
+
+
+'''
+    Description:
+        measures the code run inside it and sends the result to emit as an event dict with
+            stage - name of the stage
+            start - time.time() the stage started at
+            wall - wall time in seconds
+            cpu - cpu time of the process in seconds
+            bytes_read - bytes the process read from files and pipes, None if the platform does not report it.
+                         Memory mapped reads, e.g. from the parsed input cache, are not counted.
+            peak_rss - most resident memory of the process in bytes. Where the peak can be reset (linux) it is the peak
+                       during this stage, otherwise the peak since the process started.
+            pid - id of the process the stage ran in, which differs from the caller when layers are scored in workers
+        plus every keyword given in fields
+    Inputs:
+        emit - function from make_emitter, or None to measure nothing
+        name - name of the stage
+        fields - extra entries of the event, e.g. the layer it belongs to
+    Outputs:
+        context manager
+'''
+@contextmanager
+def stage(emit, name, **fields):
+    if emit is None:
+        yield
+        return
+
+    _reset_peak()
+    start = time.time()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    read = _bytes_read()
+    yield
+
+    event = {'stage': name,
+             'start': start,
+             'wall': time.perf_counter() - wall,
+             'cpu': time.process_time() - cpu,
+             'bytes_read': None if read is None else _bytes_read() - read,
+             'peak_rss': _peak_rss(),
+             'pid': os.getpid()}
+    event.update(fields)
+    emit(event)
+
+
+
+
+#characters read by the process through read calls, from /proc/self/io
+def _bytes_read():
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            for line in f:
+                if line.startswith(b'rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+
+
+#resets the peak resident memory of the process so the next reading only covers what comes after, where linux allows it
+def _reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+
+
+#peak resident memory of the process in bytes, None if it can not be read
+def _peak_rss():
+    try:
+        with open('/proc/self/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    #ru_maxrss is in bytes on mac and kilobytes everywhere else
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
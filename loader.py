@@ -0,0 +1,609 @@
+import os
+import re
+import json
+import glob
+import warnings
+import numpy as np
+
+
+
+
+#size of each block read from disk while parsing
+CHUNK_SIZE = 1 << 20
+
+#every separator in both formats, they are turned into spaces before the numbers are parsed
+_SEPARATOR_BYTES = [b' ', b'[', b']', b',', b'\t', b'\r', b'\n']
+_STR_SEPARATORS = str.maketrans('[],\t\r\n', '      ')
+_OPEN = ord('[')
+_CLOSE = ord(']')
+_COMMA = ord(',')
+_SPACE = ord(' ')
+
+#a raw dump can start with a line describing it, e.g. b'#raw dtype=<f4 shape=5,32,32\n', or have one in a sidecar file
+#next to it, e.g. conv1.bin.json holding {"dtype": "<i2", "shape": [5, 32, 32], "frac_bits": 8}
+RAW_HEADER = b'#raw '
+SIDECAR_SUFFIX = '.json'
+
+#files with these extensions are binary even without a header or sidecar. Bare raw dumps are little endian float32
+BINARY_EXTENSIONS = ('.npy', '.bin', '.raw', '.dat')
+_NPY_MAGIC = b'\x93NUMPY'
+
+
+
+
+'''
+    Description:
+        parses a layer output text file into a numpy array. Handles both the nested [[[ ... ]]] caffe dumps and the
+        whitespace/tab separated vivado rows, so convert_to_2d no longer has to be run before comparing.
+        Plain tables are parsed by np.loadtxt, which is the fastest numpy has for them. Bracketed and comma separated
+        dumps, which np.loadtxt can not read, are parsed a chunk at a time straight into a preallocated array, so memory
+        use stays at the size of the result plus a few chunks.
+    Inputs:
+        fileName - string name of the file to parse
+        dtype - numpy dtype of the returned array
+        chunkSize - number of bytes to read from the file at a time
+    Outputs:
+        returns the parsed array. Bracketed dumps get their shape from the bracket nesting, tables are returned as
+        (rows, columns) and single rows or columns as 1 dimensional arrays, the same as np.loadtxt.
+'''
+def load_txt(fileName, dtype=np.float32, chunkSize=CHUNK_SIZE):
+    return _parse_files([fileName], dtype, chunkSize)
+
+
+
+
+'''
+    Description:
+        loads a layer output that may be split across several files, e.g. the conv1out1..5 shards the vivado testbench
+        writes, as one array without merging the files first. The shards are parsed in order straight into one
+        preallocated array.
+    Inputs:
+        source - a file name, a glob pattern such as 'provided_vivado_files/conv1out*.txt', or a list of file names and
+                 patterns. Patterns are expanded in natural order, so conv2out10 comes after conv2out9.
+        dtype - numpy dtype of the returned array
+        chunkSize - number of bytes to read from a file at a time
+    Outputs:
+        returns the parsed array. A single file has the shape load_txt gives it; shards are joined along their first
+        dimension if the rest of their shapes agree and flattened otherwise. Binary files (.npy and raw dumps, see
+        is_binary) are memory mapped with load_binary instead of parsed, and stay mapped when dtype is their own dtype.
+'''
+def load_source(source, dtype=np.float32, chunkSize=CHUNK_SIZE):
+
+    fileNames = expand_sources(source)
+    if len(fileNames) == 1:
+        if is_binary(fileNames[0]):
+            return load_binary(fileNames[0], dtype)
+        return load_txt(fileNames[0], dtype, chunkSize)
+
+    #binary shards are already arrays, they only need joining
+    if any(is_binary(fileName) for fileName in fileNames):
+        return _join([load_source(fileName, dtype, chunkSize) for fileName in fileNames])
+
+    return _parse_files(fileNames, dtype, chunkSize)
+
+
+
+
+#parses text files in order straight into one preallocated array, shaped the way load_source describes. A single plain
+#table is returned as np.loadtxt gives it
+def _parse_files(fileNames, dtype, chunkSize):
+    if len(fileNames) == 1 and _is_table(fileNames[0], chunkSize):
+        return _load_table(fileNames[0], dtype)
+
+    out = None
+    count = 0
+    shapes = []
+    totalSize = sum(os.path.getsize(fileName) for fileName in fileNames)
+    for fileName in fileNames:
+        info = {}
+        for nums in _file_chunks(fileName, dtype, chunkSize, info):
+
+            #size the output from the density of the first chunk, growing it if that was an underestimate
+            if out is None:
+                estimate = int(totalSize * len(nums) / max(info['bytes'], 1) * 1.05) + len(nums)
+                out = np.empty(max(estimate, len(nums)), dtype=dtype)
+            elif count + len(nums) > len(out):
+                out.resize(max(2 * len(out), count + len(nums)), refcheck=False)
+            out[count:count + len(nums)] = nums
+            count += len(nums)
+        shapes.append(info['shape'])
+
+    if out is None:
+        return np.empty(0, dtype=dtype)
+    out.resize(count, refcheck=False)
+
+    return out.reshape(_joined_shape(shapes, count))
+
+
+
+
+#the values of one text file for _parse_files: a plain table in one piece from np.loadtxt, anything else a chunk at a time
+#from iter_txt. info is filled in the same way as by iter_txt
+def _file_chunks(fileName, dtype, chunkSize, info):
+    if not _is_table(fileName, chunkSize):
+        yield from iter_txt(fileName, dtype, chunkSize, info)
+        return
+
+    arr = _load_table(fileName, dtype)
+    info['bytes'] = os.path.getsize(fileName)
+    info['shape'] = arr.shape
+    if arr.size:
+        yield arr.reshape(-1)
+
+
+
+
+#shape of shards joined along the first dimension when they only differ there, otherwise flat
+def _joined_shape(shapes, count):
+    if all(len(shape) == len(shapes[0]) and shape[1:] == shapes[0][1:] for shape in shapes) and len(shapes[0]):
+        return (sum(shape[0] for shape in shapes),) + tuple(shapes[0][1:])
+    return (count,)
+
+
+
+
+#joins arrays loaded from shards the same way load_source joins parsed ones
+def _join(arrays):
+    out = np.concatenate([arr.reshape(-1) for arr in arrays])
+    return out.reshape(_joined_shape([arr.shape for arr in arrays], len(out)))
+
+
+
+
+'''
+    Description:
+        tells binary layer dumps from text ones: .npy files, raw dumps with a RAW_HEADER line or a sidecar, and files with
+        one of the BINARY_EXTENSIONS
+    Inputs:
+        fileName - string name of the file
+    Outputs:
+        returns True if the file should be loaded with load_binary
+'''
+def is_binary(fileName):
+    if fileName.lower().endswith(BINARY_EXTENSIONS) or os.path.exists(fileName + SIDECAR_SUFFIX):
+        return True
+    with open(fileName, 'rb') as f:
+        start = f.read(len(RAW_HEADER))
+    return start == RAW_HEADER or start.startswith(_NPY_MAGIC)
+
+
+
+
+'''
+    Description:
+        memory maps a binary layer dump instead of parsing text. Handles .npy files and raw little endian dumps such as the
+        buffers a testbench fwrites, described by a RAW_HEADER line at the start of the file or a sidecar json file
+        (see raw_info). Fixed point dumps are integers with frac_bits fractional bits and are scaled to real values.
+    Inputs:
+        fileName - string name of the file
+        dtype - numpy dtype of the returned array. None keeps the dtype of the file. Anything that needs converting,
+                including fixed point values, is copied into a new array; otherwise the memory map is returned.
+    Outputs:
+        returns the array, in the shape given by the header or sidecar and 1 dimensional if there is none
+'''
+def load_binary(fileName, dtype=None):
+    arr, fracBits = _map_binary(fileName)
+    if fracBits:
+        return np.multiply(arr, 2.0 ** -fracBits, dtype=np.float64 if dtype is None else dtype)
+    if dtype is not None and arr.dtype != np.dtype(dtype):
+        return arr.astype(dtype)
+    return arr
+
+
+
+
+#memory maps a .npy or raw file as stored, returning the map and the number of fractional bits of its values
+def _map_binary(fileName):
+    with open(fileName, 'rb') as f:
+        isNpy = f.read(len(_NPY_MAGIC)) == _NPY_MAGIC
+    if isNpy:
+        return np.load(fileName, mmap_mode='r'), 0
+
+    desc = raw_info(fileName)
+    arr = np.memmap(fileName, dtype=desc['dtype'], mode='r', offset=desc['offset'], shape=desc['shape'])
+    return arr, desc['frac_bits']
+
+
+
+
+'''
+    Description:
+        reads the description of a raw dump, from its header line, its sidecar file or, failing both, its size
+    Inputs:
+        fileName - string name of the raw file
+    Outputs:
+        returns a dict with
+            dtype - numpy dtype of the values, little endian float32 if nothing says otherwise
+            shape - tuple shape of the values
+            frac_bits - number of fractional bits of fixed point values, 0 for floats
+            offset - byte offset of the first value
+'''
+def raw_info(fileName):
+    desc = {}
+    offset = 0
+    with open(fileName, 'rb') as f:
+        if f.read(len(RAW_HEADER)) == RAW_HEADER:
+            line = f.readline()
+            offset = f.tell()
+            for item in line.decode('ascii').split():
+                key, value = item.split('=', 1)
+                desc[key] = [int(n) for n in value.split(',') if n] if key == 'shape' else value
+
+    if not desc and os.path.exists(fileName + SIDECAR_SUFFIX):
+        with open(fileName + SIDECAR_SUFFIX, 'r') as f:
+            desc = json.load(f)
+
+    dtype = np.dtype(desc.get('dtype', '<f4'))
+    offset = int(desc.get('offset', offset))
+    shape = desc.get('shape')
+    if shape is None:
+        shape = ((os.path.getsize(fileName) - offset) // dtype.itemsize,)
+    return {'dtype': dtype, 'shape': tuple(shape), 'frac_bits': int(desc.get('frac_bits', 0)), 'offset': offset}
+
+
+
+
+'''
+    Description:
+        turns a file name, glob pattern or list of them into the list of files they refer to
+    Inputs:
+        source - a file name, a glob pattern, or a list of file names and patterns
+    Outputs:
+        returns a list of file names, patterns expanded in natural order
+'''
+def expand_sources(source):
+    if isinstance(source, (list, tuple)):
+        return [fileName for item in source for fileName in expand_sources(item)]
+
+    if '*' in source or '?' in source:
+        fileNames = sorted(glob.glob(source), key=_natural_key)
+        if not fileNames:
+            raise IOError('no files match ' + source)
+        return fileNames
+    return [source]
+
+
+
+
+#sort key that orders the numbers inside file names by value, conv2out9 before conv2out10
+def _natural_key(fileName):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', fileName)]
+
+
+
+
+'''
+    Description:
+        parses a layer output text file one chunk at a time, the streaming version of load_txt. Only one chunk of the
+        file is held in memory at once.
+    Inputs:
+        fileName - string name of the file to parse
+        dtype - numpy dtype of the yielded arrays
+        chunkSize - number of bytes to read from the file at a time
+        info - optional dict. 'bytes' is kept up to date with the number of bytes parsed so far, and once the file has
+               been read to the end 'shape' holds the shape load_txt would have returned.
+    Outputs:
+        yields 1 dimensional arrays of consecutive values, in file order
+'''
+def iter_txt(fileName, dtype=np.float32, chunkSize=CHUNK_SIZE, info=None):
+
+    if info is None:
+        info = {}
+    info['bytes'] = 0
+    count = 0
+
+    #values on the first non-empty line, which a table's width is taken from. Bracketed dumps do not need it
+    firstCols = None
+    lineCols = 0
+    bracketed = False
+
+    #bracket bookkeeping. closed[k] counts the lists closed at depth k
+    depth = 0
+    closed = np.zeros(1, dtype=np.int64)
+
+    #the file is read into one reused buffer, the unparsed end of a chunk is moved to its front before the next read
+    buf = bytearray(chunkSize)
+    carried = 0
+    with open(fileName, 'rb') as f:
+        while True:
+            #a number longer than the buffer makes it grow
+            if carried == len(buf):
+                buf = buf + bytearray(len(buf))
+            view = memoryview(buf)
+            got = f.readinto(view[carried:])
+            end = carried + got
+            if end == 0:
+                break
+            raw = np.frombuffer(buf, dtype=np.uint8, count=end)
+
+            #keep track of the nesting so the shape can be recovered at the end. The carried end of the last chunk has
+            #no separators in it, so no bracket is counted twice
+            brackets = (raw == _OPEN) | (raw == _CLOSE)
+            idx = np.flatnonzero(brackets)
+            if len(idx):
+                bracketed = True
+                step = np.where(raw[idx] == _OPEN, 1, -1)
+                after = depth + np.cumsum(step)
+                if after.min() < 0:
+                    raise ValueError(fileName + ' has unbalanced brackets')
+                levels = after[step < 0] + 1
+                if len(levels):
+                    hits = np.bincount(levels)
+                    if len(hits) > len(closed):
+                        closed = np.concatenate((closed, np.zeros(len(hits) - len(closed), dtype=np.int64)))
+                    closed[:len(hits)] += hits
+                depth = int(after[-1])
+
+            #only parse up to the last separator so numbers are never split across chunks
+            cut = end
+            if got:
+                cut = _last_separator(buf, end) + 1
+                if cut == 0:
+                    carried = end
+                    continue
+            info['bytes'] += cut
+
+            #count the values of the first line in this chunk, so a line longer than a chunk is never held whole
+            start = 0
+            while firstCols is None and not bracketed:
+                newline = buf.find(b'\n', start, cut)
+                lineCols += _count_numbers(raw[start:cut if newline == -1 else newline])
+                if newline == -1:
+                    break
+                if lineCols:
+                    firstCols = lineCols
+                start = newline + 1
+
+            #brackets and commas become spaces in place, np.fromstring skips any other whitespace itself. Then the parsed
+            #part is copied once into the bytes np.fromstring needs
+            np.putmask(raw, brackets | (raw == _COMMA), _SPACE)
+            text = bytes(view[:cut])
+            carried = end - cut
+            buf[:carried] = buf[cut:end]
+            del raw, view
+
+            if text.isspace():
+                continue
+            nums = _parse(text, dtype, fileName)
+            count += len(nums)
+            yield nums
+
+    if depth != 0:
+        raise ValueError(fileName + ' has unbalanced brackets')
+    if firstCols is None and lineCols:
+        firstCols = lineCols
+    if count == 0:
+        info['shape'] = (0,)
+    elif len(closed) > 1:
+        info['shape'] = _bracket_shape(closed, count, fileName)
+    else:
+        info['shape'] = _table_shape(firstCols, count, fileName)
+
+
+
+
+'''
+    Description:
+        streams a layer output as blocks of a fixed number of values, so two sources with different line layouts or shards
+        can be walked through side by side. Binary dumps (see load_binary) are read from a memory map, text files a chunk
+        at a time with iter_txt.
+    Inputs:
+        source - a file name, glob pattern or list of them, the same as load_source. Shards are streamed one after the other.
+        blockSize - number of values in each block. Only the last block can be shorter.
+        dtype - numpy dtype of the yielded arrays
+        info - optional dict. 'bytes' is the number of bytes read so far, and once every shard has been read 'shape' holds
+               the shape load_source would have returned.
+    Outputs:
+        yields 1 dimensional arrays of blockSize values, in file order
+'''
+def iter_blocks(source, blockSize, dtype=np.float32, info=None):
+
+    if info is None:
+        info = {}
+    shapes = []
+    count = 0
+    buf = np.empty(blockSize, dtype=dtype)
+    filled = 0
+    for nums in _source_chunks(expand_sources(source), blockSize, dtype, info, shapes):
+        count += len(nums)
+
+        #a whole block that lines up needs no copying
+        if filled == 0 and len(nums) == blockSize:
+            yield nums
+            continue
+
+        start = 0
+        while start < len(nums):
+            take = min(blockSize - filled, len(nums) - start)
+            buf[filled:filled + take] = nums[start:start + take]
+            filled += take
+            start += take
+            if filled == blockSize:
+                yield buf.copy()
+                filled = 0
+
+    if filled:
+        yield buf[:filled].copy()
+    info['shape'] = _joined_shape(shapes, count) if shapes else (0,)
+
+
+
+
+#the values of every shard in order for iter_blocks, binary ones sliced from their memory map a block at a time and text
+#ones parsed a chunk at a time. The shape of each shard is appended to shapes once it has been read
+def _source_chunks(fileNames, blockSize, dtype, info, shapes):
+    info['bytes'] = 0
+    for fileName in fileNames:
+        if is_binary(fileName):
+            arr, fracBits = _map_binary(fileName)
+            flat = arr.reshape(-1)
+            for start in range(0, len(flat), blockSize):
+                block = flat[start:start + blockSize]
+                info['bytes'] += block.nbytes
+                yield np.multiply(block, 2.0 ** -fracBits, dtype=dtype)
+            shapes.append(arr.shape)
+            continue
+
+        fileInfo = {}
+        parsed = info['bytes']
+        for nums in iter_txt(fileName, dtype, info=fileInfo):
+            info['bytes'] = parsed + fileInfo['bytes']
+            yield nums
+        shapes.append(fileInfo['shape'])
+
+
+
+
+'''
+    Description:
+        streams the numbers of a layer output text file as the strings they are written as, without parsing them, so they
+        can be copied to another file exactly
+    Inputs:
+        fileName - string name of the file to read
+        chunkSize - number of characters to read from the file at a time
+    Outputs:
+        yields lists of number strings, in file order
+'''
+def iter_tokens(fileName, chunkSize=CHUNK_SIZE):
+    carry = ''
+    with open(fileName, 'r') as f:
+        while True:
+            block = f.read(chunkSize)
+            text = (carry + block).translate(_STR_SEPARATORS)
+            if not text:
+                break
+
+            #hold back a number that may continue in the next chunk
+            if block:
+                cut = text.rfind(' ') + 1
+                carry = text[cut:]
+                text = text[:cut]
+            else:
+                carry = ''
+
+            tokens = text.split()
+            if tokens:
+                yield tokens
+            if not block:
+                break
+
+
+
+
+'''
+    Description:
+        works out how many values go on each row when a file is laid out in 2D, without reading more of it than needed.
+        For a bracketed dump this is the length of its innermost lists, i.e. its last dimension, and 1 for a plain
+        [ ... ] list so fc outputs come out one value per line. For a table it is the width of the first line.
+    Inputs:
+        fileName - string name of the file to read
+        chunkSize - number of characters to read from the file at a time
+    Outputs:
+        returns the number of values per row
+'''
+def row_width(fileName, chunkSize=1 << 16):
+    head = ''
+    with open(fileName, 'r') as f:
+        while True:
+            block = f.read(chunkSize)
+            head += block
+            end = head.find(']')
+
+            #the first list to close is an innermost one
+            if end != -1:
+                depth = head.count('[', 0, end)
+                if depth <= 1:
+                    return 1
+                start = head.rfind('[', 0, end)
+                return len(head[start + 1:end].translate(_STR_SEPARATORS).split())
+
+            #no brackets, use the first non-empty line
+            if '[' not in head:
+                lines = head.split('\n')
+                for line in lines[:-1] if block else lines:
+                    if line.strip():
+                        return len(line.translate(_STR_SEPARATORS).split())
+            if not block:
+                return 1
+
+
+
+
+#parses a chunk of space separated numbers, refusing to silently stop at anything that is not a number
+def _parse(text, dtype, fileName):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(text, dtype=dtype, sep=' ')
+        except (ValueError, DeprecationWarning):
+            raise ValueError(fileName + ' contains text that is not a number')
+
+
+
+
+#index of the last separator in the first end bytes of a buffer, -1 if there is none
+def _last_separator(buf, end):
+    return max(buf.rfind(sep, 0, end) for sep in _SEPARATOR_BYTES)
+
+
+
+
+#number of whitespace or comma separated numbers in a piece of a table without brackets, counted without splitting it
+def _count_numbers(raw):
+    if len(raw) == 0:
+        return 0
+    sep = (raw == _SPACE) | (raw == _COMMA) | (raw == ord('\t')) | (raw == ord('\r')) | (raw == ord('\n'))
+    return int(not sep[0]) + int(np.count_nonzero(sep[:-1] & ~sep[1:]))
+
+
+
+
+#works out the tensor shape from the number of lists closed at each bracket depth
+def _bracket_shape(closed, count, fileName):
+    lists = [int(n) for n in closed[1:]] + [count]
+    shape = []
+    for k in range(1, len(lists)):
+        if lists[k-1] == 0 or lists[k] % lists[k-1] != 0:
+            raise ValueError(fileName + ' has ragged brackets')
+        shape.append(lists[k] // lists[k-1])
+
+    #several top level lists become their own leading dimension
+    if lists[0] > 1:
+        shape.insert(0, lists[0])
+    return tuple(shape)
+
+
+
+
+#whether a file is a plain whitespace separated table that np.loadtxt reads well, going by its first chunk. A first line
+#longer than a chunk is left to iter_txt, as np.loadtxt holds whole lines in memory
+def _is_table(fileName, chunkSize=CHUNK_SIZE):
+    with open(fileName, 'rb') as f:
+        head = f.read(chunkSize)
+    return b'[' not in head and b',' not in head and (b'\n' in head or len(head) < chunkSize)
+
+
+
+
+#parses a plain table with np.loadtxt, squeezed the same way as the other formats
+def _load_table(fileName, dtype):
+    with warnings.catch_warnings():
+        #an empty file is an empty array, not a warning
+        warnings.simplefilter('ignore', UserWarning)
+        try:
+            return np.loadtxt(fileName, dtype=dtype, ndmin=1)
+        except ValueError:
+            raise ValueError(fileName + ' is not a table of numbers')
+
+
+
+
+#works out the shape of a table from the number of values on its first line, squeezing it the same way np.loadtxt does
+def _table_shape(numCols, count, fileName):
+    if numCols is None:
+        numCols = count
+    if numCols == 0 or count % numCols != 0:
+        raise ValueError(fileName + ' has rows of different lengths')
+    if numCols == 1 or numCols == count:
+        return (count,)
+    return (count // numCols, numCols)
@@ -0,0 +1,107 @@
+import os
+import numpy as np
+from tiles import as_channels
+from report import create_report, write_layer
+from compare import read_pairs, load_pair, similarity
+from constants import BLOCK_SIZE, THRESHOLD
+
+
+
+
+#number of failing channels and rows listed
+MAX_LISTED = 10
+
+
+
+
+'''
+    Description:
+        finds the first layer where the cpp network diverges from caffe instead of comparing every layer. Layers are
+        loaded and scored one at a time in the order of filenames.txt and the walk stops at the first layer whose average
+        similarity is at or below threshold, so the layers after it are never parsed. Inside that layer the search narrows
+        from channels to rows to values: the similarity of every channel is worked out a block of channels at a time,
+        then only the first failing channel is scored row by row. No error array the size of the layer is kept.
+    Inputs:
+        caffe_path - path to directory holding files of caffe layer's outputs, with a filenames.txt listing them in order
+        cpp_path  - path to directory holding files of cpp layer's outputs, with a filenames.txt listing them in the same order
+        threshold - a layer, channel or row fails when its average similarity is at or below this. A single value fails
+                    the same way.
+        cacheDir - optional directory to keep parsed copies of the text files in, see compare.compare
+        excelFileName - optional name of an excel file to write the caffe, cpp and error sheets of just the first failing
+                        channel to
+    Outputs:
+        returns None if every layer passes, otherwise a dict with
+            layer, file - index of the failing layer in filenames.txt and its caffe file
+            similarity - average similarity of the layer
+            passed - list of (file, similarity) of the layers before it
+            channel_similarity - average similarity of every channel of the layer. Channels are the first axis of the
+                                 caffe tensor, see tiles.as_channels; a 1 dimensional fc output is one channel of one row.
+            channels - the first MAX_LISTED failing channels
+            rows - the first MAX_LISTED failing rows of the first failing channel
+            first - (channel, row, col) of the first failing value in the first failing channel, None if no single value
+                    fails even though the channel does
+'''
+def localize(caffe_path, cpp_path, threshold=THRESHOLD, cacheDir=None, excelFileName=None):
+
+    passed = []
+    for i, (caffePath, cppPath, caffeSheetName, cppSheetName, errorSheetName) in enumerate(read_pairs(caffe_path, cpp_path)):
+        caffe, cpp = load_pair(caffePath, cppPath, cacheDir, keepShape=True)
+        caffe = as_channels(caffe)
+        cpp = cpp.reshape(caffe.shape)
+
+        sums = _channel_sums(caffe, cpp)
+        perChannel = caffe.shape[1] * caffe.shape[2]
+        average = sums.sum() / caffe.size if caffe.size else np.nan
+        name = os.path.basename(caffePath)
+        if not average <= threshold:
+            print(name + ' passed with {:.6f}'.format(average))
+            passed.append((name, float(average)))
+            continue
+        print(name + ' failed with {:.6f}'.format(average))
+
+        #narrow down to channels, then rows and values of the first failing channel
+        channelSimilarity = sums / perChannel
+        channels = np.flatnonzero(channelSimilarity <= threshold)
+        result = {'layer': i,
+                  'file': name,
+                  'similarity': float(average),
+                  'passed': passed,
+                  'channel_similarity': channelSimilarity,
+                  'channels': channels[:MAX_LISTED].tolist(),
+                  'rows': [],
+                  'first': None}
+
+        if len(channels):
+            c = int(channels[0])
+            error, _ = similarity(caffe[c], cpp[c])
+            rows = np.flatnonzero(np.average(error, axis=1) <= threshold)
+            result['rows'] = rows[:MAX_LISTED].tolist()
+
+            failing = np.argwhere(error <= threshold)
+            if len(failing):
+                result['first'] = (c, int(failing[0][0]), int(failing[0][1]))
+
+            if excelFileName is not None:
+                workbook = create_report(excelFileName)
+                write_layer(workbook, caffe[c], cpp[c], error, np.average(error),
+                            caffeSheetName, cppSheetName, errorSheetName + ' channel ' + str(c))
+                workbook.close()
+
+        return result
+
+    return None
+
+
+
+
+#sum of the similarity of every channel, worked out a block of channels at a time
+def _channel_sums(caffe, cpp):
+    numChannels = caffe.shape[0]
+    perChannel = caffe.shape[1] * caffe.shape[2]
+    sums = np.zeros(numChannels)
+
+    step = max(1, BLOCK_SIZE // max(perChannel, 1))
+    for c0 in range(0, numChannels, step):
+        error, _ = similarity(caffe[c0:c0 + step], cpp[c0:c0 + step])
+        sums[c0:c0 + step] = error.reshape(len(error), -1).sum(axis=1)
+    return sums
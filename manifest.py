@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import numpy as np
+from cache import cache_key
+from constants import THRESHOLD
+
+
+
+
+#files kept next to the workbook, e.g. synchronous_map.xlsx.manifest.json and synchronous_map.xlsx.results/
+MANIFEST_SUFFIX = '.manifest.json'
+RESULTS_SUFFIX = '.results'
+MANIFEST_VERSION = 1
+
+
+
+
+'''
+    Description:
+        reads the manifest auto_compare left next to a workbook on its last incremental run
+    Inputs:
+        excelFileName - name of the excel file the manifest belongs to
+    Outputs:
+        returns a dict with a 'layers' dict of the stored entries, keyed by layer_key. Empty if there is no usable manifest.
+'''
+def read_manifest(excelFileName):
+    try:
+        with open(excelFileName + MANIFEST_SUFFIX, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        manifest = {'version': MANIFEST_VERSION, 'layers': {}}
+    return manifest
+
+
+
+
+'''
+    Description:
+        writes the manifest next to the workbook and deletes stored error arrays that no entry refers to anymore
+    Inputs:
+        excelFileName - name of the excel file the manifest belongs to
+        manifest - dict from read_manifest, updated with store_result
+        keep - optional list of layer keys to keep. Entries for any other layer are dropped.
+    Outputs:
+        does not return anything but the manifest file has been written
+'''
+def write_manifest(excelFileName, manifest, keep=None):
+    if keep is not None:
+        manifest['layers'] = {key: manifest['layers'][key] for key in keep if key in manifest['layers']}
+
+    path = excelFileName + MANIFEST_SUFFIX
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmpPath, path)
+
+    #drop error arrays from earlier runs
+    errorDir = os.path.join(results_dir(excelFileName), 'errors')
+    if os.path.isdir(errorDir):
+        used = set(entry['error'] for entry in manifest['layers'].values())
+        for name in os.listdir(errorDir):
+            if name.endswith('.npy') and name not in used:
+                os.remove(os.path.join(errorDir, name))
+
+
+
+
+'''
+    Description:
+        directory next to the workbook where incremental runs keep the error arrays and, unless told otherwise, the cache
+        of parsed inputs
+    Inputs:
+        excelFileName - name of the excel file
+    Outputs:
+        returns the path of the directory, ending in a separator
+'''
+def results_dir(excelFileName):
+    return excelFileName + RESULTS_SUFFIX + os.sep
+
+
+
+
+#identifies a layer pair independently of where it sits in filenames.txt
+def layer_key(caffePath, cppPath):
+    return os.path.abspath(caffePath) + '|' + os.path.abspath(cppPath)
+
+
+
+
+'''
+    Description:
+        fingerprints the two inputs of a layer, with the same keys the parsed input cache uses
+    Inputs:
+        caffePath - string name of the caffe file
+        cppPath - string name of the cpp file
+        useHash - if True the file contents are hashed as well as the size and modification time
+    Outputs:
+        returns a dict with 'caffe' and 'cpp' fingerprints
+'''
+def fingerprint(caffePath, cppPath, useHash=False):
+    return {'caffe': cache_key(caffePath, np.float64, useHash),
+            'cpp': cache_key(cppPath, np.float64, useHash)}
+
+
+
+
+'''
+    Description:
+        looks up the stored result of a layer whose inputs have not changed since it was stored
+    Inputs:
+        manifest - dict from read_manifest
+        excelFileName - name of the excel file the manifest belongs to
+        key - layer_key of the pair
+        prints - fingerprint of the pair's current inputs
+    Outputs:
+        returns (error, stats) with error memory mapped from disk, or None if the layer has to be compared again
+'''
+def lookup_result(manifest, excelFileName, key, prints):
+    entry = manifest['layers'].get(key)
+    if entry is None or entry['inputs'] != prints:
+        return None
+
+    try:
+        error = np.load(os.path.join(results_dir(excelFileName), 'errors', entry['error']), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return error, entry['stats']
+
+
+
+
+'''
+    Description:
+        stores the result of a layer so the next incremental run can reuse it
+    Inputs:
+        manifest - dict from read_manifest
+        excelFileName - name of the excel file the manifest belongs to
+        key - layer_key of the pair
+        prints - fingerprint of the pair's inputs
+        error - array of the similarity between the two, as written to the error sheet
+        stats - dict of summary statistics from layer_stats
+    Outputs:
+        does not return anything but the error array has been saved and the manifest updated
+'''
+def store_result(manifest, excelFileName, key, prints, error, stats):
+    errorDir = os.path.join(results_dir(excelFileName), 'errors')
+    os.makedirs(errorDir, exist_ok=True)
+
+    name = hashlib.sha1((prints['caffe'] + '|' + prints['cpp']).encode()).hexdigest()[:20] + '.npy'
+    np.save(os.path.join(errorDir, name), error)
+    manifest['layers'][key] = {'inputs': prints, 'error': name, 'stats': stats}
+
+
+
+
+'''
+    Description:
+        summary statistics of a layer's error that are kept in the manifest
+    Inputs:
+        error - array of the similarity between the two layers
+        ave_error - average of error
+        threshold - errors at or below this are counted as failing
+    Outputs:
+        returns a dict of plain python numbers that can be written to json
+'''
+def layer_stats(error, ave_error, threshold=THRESHOLD):
+    return {'ave_error': float(ave_error),
+            'min': float(np.min(error)) if error.size else None,
+            'max': float(np.max(error)) if error.size else None,
+            'below': int(np.count_nonzero(error <= threshold)),
+            'count': int(error.size),
+            'shape': list(error.shape)}
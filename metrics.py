@@ -0,0 +1,174 @@
+import numpy as np
+from loader import load_source
+from constants import BLOCK_SIZE
+
+
+
+
+#whole layer metrics returned by layer_metrics, in the order they are written to a metrics sheet
+METRICS = ['similarity', 'abs_error', 'max_error', 'cosine', 'snr', 'ulp_mean', 'ulp_max']
+
+
+
+
+'''
+    Description:
+        computes every comparison metric of a layer in one blocked pass, both for the whole layer and for each output
+        channel. Channels are taken along the first axis of shape, so a (channels, rows, cols) caffe dump gives one set of
+        metrics per channel and a 1 dimensional fc output one per neuron. Only a block of channels is converted and compared
+        at a time, so there are no temporaries the size of the whole layer.
+    Inputs:
+        caffe - array of the caffe layer's output
+        cpp - array of the cpp layer's output, with the same number of values
+        shape - shape to split the values into channels with. Defaults to the shape of caffe.
+        blockSize - roughly how many values to compare at a time
+    Outputs:
+        returns a dict of whole layer metrics
+            similarity - average of the relative similarity compare puts on the error sheet
+            abs_error - mean absolute difference
+            max_error - largest absolute difference
+            cosine - cosine similarity of the two tensors
+            snr - signal to noise ratio of cpp against caffe in dB, inf if they are identical
+            ulp_mean, ulp_max - mean and largest distance in float32 units in the last place
+        plus 'channels', a dict with the same keys holding one value per channel
+'''
+def layer_metrics(caffe, cpp, shape=None, blockSize=BLOCK_SIZE):
+
+    if shape is None:
+        shape = caffe.shape
+    assert caffe.size == cpp.size
+    numChannels = shape[0] if len(shape) else 1
+    caffe = caffe.reshape(numChannels, -1)
+    cpp = cpp.reshape(numChannels, -1)
+    perChannel = caffe.shape[1]
+
+    #running sums for each channel
+    sim = np.zeros(numChannels)
+    absSum = np.zeros(numChannels)
+    absMax = np.zeros(numChannels)
+    dot = np.zeros(numChannels)
+    caffeSq = np.zeros(numChannels)
+    cppSq = np.zeros(numChannels)
+    diffSq = np.zeros(numChannels)
+    ulpSum = np.zeros(numChannels)
+    ulpMax = np.zeros(numChannels, dtype=np.int64)
+
+    step = max(1, blockSize // max(perChannel, 1))
+    for c0 in range(0, numChannels, step):
+        c1 = min(c0 + step, numChannels)
+        a = caffe[c0:c1].astype(np.float64)
+        b = cpp[c0:c1].astype(np.float64)
+
+        dot[c0:c1] = np.einsum('ij,ij->i', a, b)
+        caffeSq[c0:c1] = np.einsum('ij,ij->i', a, a)
+        cppSq[c0:c1] = np.einsum('ij,ij->i', b, b)
+
+        d = np.subtract(a, b)
+        diffSq[c0:c1] = np.einsum('ij,ij->i', d, d)
+        np.absolute(d, out=d)
+        absSum[c0:c1] = d.sum(axis=1)
+        absMax[c0:c1] = d.max(axis=1, initial=0)
+
+        ulp = ulp_distance(a, b)
+        ulpSum[c0:c1] = ulp.sum(axis=1)
+        ulpMax[c0:c1] = ulp.max(axis=1, initial=0)
+
+        sim[c0:c1] = perChannel - relative_difference(a, b, inPlace=True).sum(axis=1)
+
+    count = numChannels * perChannel
+    channels = {'similarity': sim / perChannel,
+                'abs_error': absSum / perChannel,
+                'max_error': absMax,
+                'cosine': _cosine(dot, caffeSq, cppSq),
+                'snr': _snr(caffeSq, diffSq),
+                'ulp_mean': ulpSum / perChannel,
+                'ulp_max': ulpMax}
+
+    return {'similarity': sim.sum() / count,
+            'abs_error': absSum.sum() / count,
+            'max_error': absMax.max(initial=0),
+            'cosine': _cosine(dot.sum(), caffeSq.sum(), cppSq.sum()),
+            'snr': _snr(caffeSq.sum(), diffSq.sum()),
+            'ulp_mean': ulpSum.sum() / count,
+            'ulp_max': ulpMax.max(initial=0),
+            'channels': channels}
+
+
+
+
+'''
+    Description:
+        loads a pair of layer output files and computes their metrics with layer_metrics. The channels come from the shape
+        of the caffe file, so a raw [[[ ... ]]] dump should be passed rather than one run through convert_to_2d.
+    Inputs:
+        caffetxt - string name of file where the caffe layer's output is stored
+        cpptxt - string name of file where the cpp layer's output is stored, or a glob pattern or list of shards
+    Outputs:
+        returns the dict from layer_metrics
+'''
+def file_metrics(caffetxt, cpptxt):
+    #float64 like compare, so similarity matches its ave_error
+    caffe = load_source(caffetxt, dtype=np.float64)
+    cpp = load_source(cpptxt, dtype=np.float64)
+    return layer_metrics(caffe, cpp, caffe.shape)
+
+
+
+
+'''
+    Description:
+        relative difference of every value, |caffe-cpp| / max(caffe,cpp) with 0/0 counted as no difference. The
+        similarity on the error sheet is 1 minus this, and every other similarity (metrics, stream_stats) is worked out
+        from it too so they all agree.
+    Inputs:
+        caffe - array of the caffe layer's output
+        cpp - array of the cpp layer's output, same shape as caffe
+        inPlace - if True caffe is overwritten with max(caffe,cpp) instead of allocating another array for it. caffe has
+                  to be a float64 array that can be thrown away.
+    Outputs:
+        returns a new float64 array of the same shape
+'''
+def relative_difference(caffe, cpp, inPlace=False):
+    diff = np.subtract(caffe, cpp, dtype=np.float64)
+    np.absolute(diff, out=diff)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(diff, np.maximum(caffe, cpp, out=caffe if inPlace else None), out=diff)
+    return np.nan_to_num(diff, copy=False)
+
+
+
+
+'''
+    Description:
+        distance between two arrays in float32 units in the last place, i.e. how many float32 values lie between them
+    Inputs:
+        a, b - arrays of the same shape, converted to float32 first
+    Outputs:
+        returns an int64 array of distances
+'''
+def ulp_distance(a, b):
+    return np.abs(_ordered(a) - _ordered(b))
+
+
+
+
+#maps float32 bit patterns to integers that are ordered the same way as the floats, with -0.0 and 0.0 equal
+def _ordered(x):
+    i = np.asarray(x, dtype=np.float32).view(np.int32).astype(np.int64)
+    return np.where(i < 0, -(i & 0x7fffffff), i)
+
+
+
+
+#cosine similarity from the dot product and squared norms, nan when either tensor is all zeros
+def _cosine(dot, caffeSq, cppSq):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return dot / (np.sqrt(caffeSq) * np.sqrt(cppSq))
+
+
+
+
+#signal to noise ratio in dB from the squared norms of the reference and of the difference
+def _snr(caffeSq, diffSq):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 10 * np.log10(caffeSq / diffSq)
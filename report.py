@@ -0,0 +1,338 @@
+import numpy as np
+import xlsxwriter
+from contextlib import nullcontext
+from tiles import tile_pyramid, channel_stats, worst_cells, WORST_CELLS
+from fixed import lsb_stats
+from metrics import METRICS
+from constants import THRESHOLD
+
+
+
+
+#number of values of a 1 dimensional array converted and written at a time
+COLUMN_BLOCK = 1 << 16
+
+#most rows and columns a sheet can hold. xlsxwriter silently drops cells past them
+MAX_ROWS = 1048576
+MAX_COLS = 16384
+
+
+
+
+'''
+    Description:
+        creates the workbook the comparisons are written to. It is opened in constant_memory mode so every row is flushed
+        to disk as soon as the next one is started, keeping memory flat no matter how large the layers are.
+    Inputs:
+        name - string name of the excel file to be created
+    Outputs:
+        returns an xlsxwriter workbook to pass to write_layer
+'''
+def create_report(name):
+    return xlsxwriter.Workbook(name, {'constant_memory': True, 'nan_inf_to_errors': True})
+
+
+
+
+'''
+    Description:
+        writes the caffe, cpp and error sheets of one layer. Rows are written whole with write_row and the error sheet is
+        colored by two conditional formats over its data range instead of a format on every cell.
+        Rows have to be written top to bottom because the workbook is in constant_memory mode, so the average is written
+        to the top of the error sheet before the data.
+    Inputs:
+        workbook - workbook created by create_report
+        caffe - 1 or 2 dimensional array of the caffe layer's output
+        cpp - array of the cpp layer's output, same shape as caffe
+        error - array of the similarity between the two, same shape as caffe
+        ave_error - average of error
+        caffeSheetName - string name of the caffe sheet. If nothing is provided will default to Sheet1, Sheet2, etc.
+        cppSheetName - string name of the cpp sheet. If nothing is provided will default to Sheet1, Sheet2, etc.
+        errorSheetName - string name of the error sheet. If nothing is provided will default to Sheet1, Sheet2, etc.
+        record - optional function taking a stage name ('caffe sheet', 'cpp sheet' or 'error sheet') and returning a context
+                 manager the writing of that sheet is done in, e.g. to time it with instrument.stage
+    Outputs:
+        does not return anything but three sheets have been added to the workbook
+'''
+def write_layer(workbook, caffe, cpp, error, ave_error, caffeSheetName=None, cppSheetName=None, errorSheetName=None, record=None):
+
+    if record is None:
+        record = lambda name: nullcontext()
+
+    caffeSheet = workbook.add_worksheet(caffeSheetName)
+    cppSheet = workbook.add_worksheet(cppSheetName)
+    errorSheet = workbook.add_worksheet(errorSheetName)
+
+    with record('caffe sheet'):
+        write_array(caffeSheet, caffe)
+    with record('cpp sheet'):
+        write_array(cppSheet, cpp)
+    with record('error sheet'):
+        _write_error(workbook, errorSheet, error, ave_error)
+
+
+
+
+#writes the average and the values of the error sheet and colors them
+def _write_error(workbook, errorSheet, error, ave_error):
+    errorSheet.write('D1','Average : ')
+    errorSheet.write('E1',ave_error)
+    write_array(errorSheet, error)
+
+    #color the whole error range at once
+    if error.size:
+        _color(workbook, errorSheet, data_range(error))
+
+
+
+
+#colors a (first_row, first_col, last_row, last_col) range of a sheet with two conditional formats: green where a cell
+#meets the first of criteria against value and red where it meets the second
+def _color(workbook, sheet, cells, criteria=('>', '<='), value=THRESHOLD):
+    greenFill = workbook.add_format({'bg_color': 'green'})
+    redFill = workbook.add_format({'bg_color': 'red'})
+    sheet.conditional_format(*cells, {'type': 'cell', 'criteria': criteria[0], 'value': value, 'format': greenFill})
+    sheet.conditional_format(*cells, {'type': 'cell', 'criteria': criteria[1], 'value': value, 'format': redFill})
+
+
+
+
+'''
+    Description:
+        writes the caffe, cpp and LSB difference sheets of one layer compared in fixed point (see fixed.lsb_diff). The top of
+        the LSB sheet has the fraction of values that match bit for bit and the largest difference; exact values are
+        colored green and every other one red.
+    Inputs:
+        workbook - workbook created by create_report
+        caffe - 1 or 2 dimensional array of the caffe layer's output
+        cpp - array of the cpp layer's output, same shape as caffe
+        lsb - int64 array of the difference of every value in LSBs, same shape as caffe
+        caffeSheetName - string name of the caffe sheet. If nothing is provided will default to Sheet1, Sheet2, etc.
+        cppSheetName - string name of the cpp sheet. If nothing is provided will default to Sheet1, Sheet2, etc.
+        lsbSheetName - string name of the LSB sheet. If nothing is provided will default to Sheet1, Sheet2, etc.
+        record - optional function returning a context manager for each sheet, see write_layer. The LSB sheet is written
+                 in the 'error sheet' stage.
+    Outputs:
+        does not return anything but three sheets have been added to the workbook
+'''
+def write_fixed_layer(workbook, caffe, cpp, lsb, caffeSheetName=None, cppSheetName=None, lsbSheetName=None, record=None):
+
+    if record is None:
+        record = lambda name: nullcontext()
+
+    caffeSheet = workbook.add_worksheet(caffeSheetName)
+    cppSheet = workbook.add_worksheet(cppSheetName)
+    lsbSheet = workbook.add_worksheet(lsbSheetName)
+
+    with record('caffe sheet'):
+        write_array(caffeSheet, caffe)
+    with record('cpp sheet'):
+        write_array(cppSheet, cpp)
+    with record('error sheet'):
+        stats = lsb_stats(lsb)
+        lsbSheet.write_row(0, 3, ['Exact : ', stats['exact'], 'Max LSB : ', stats['max_lsb']])
+        write_array(lsbSheet, lsb)
+
+        if lsb.size:
+            _color(workbook, lsbSheet, data_range(lsb), ('==', '!='), 0)
+
+
+
+
+'''
+    Description:
+        writes the reduced form of one layer's comparison instead of every value, so the report stays small for large layers.
+        The tile sheet has the average, the mean, min and fraction failing of every channel, and for each tile size the
+        maps of the mean, min and fraction failing of every tile side by side, channels stacked like the rows of the error
+        sheet. The worst sheet lists the lowest similarities with their position and the caffe and cpp values.
+    Inputs:
+        workbook - workbook created by create_report
+        caffe - array of the caffe layer's output in its tensor shape, e.g. (channels, rows, cols)
+        cpp - array of the cpp layer's output, same shape as caffe
+        error - array of the similarity between the two, same shape as caffe
+        ave_error - average of error
+        tileSheetName - string name of the tile sheet. If nothing is provided will default to Sheet1, Sheet2, etc.
+        worstSheetName - string name of the worst sheet. If nothing is provided will default to Sheet1, Sheet2, etc.
+        tileSizes - list of tile sizes to write maps for, see tiles.tile_pyramid
+        worst - number of lowest similarities to list
+        record - optional function taking a stage name ('tile sheet' or 'worst sheet') and returning a context manager the
+                 writing of that sheet is done in, see write_layer
+    Outputs:
+        does not return anything but two sheets have been added to the workbook
+'''
+def write_tiles(workbook, caffe, cpp, error, ave_error, tileSheetName=None, worstSheetName=None, tileSizes=(16,), worst=WORST_CELLS, record=None):
+
+    if record is None:
+        record = lambda name: nullcontext()
+
+    tileSheet = workbook.add_worksheet(tileSheetName)
+    worstSheet = workbook.add_worksheet(worstSheetName)
+
+    with record('tile sheet'):
+        _write_tile_maps(workbook, tileSheet, error, ave_error, tileSizes)
+    with record('worst sheet'):
+        _write_worst(worstSheet, caffe, cpp, error, worst)
+
+
+
+
+#writes the average, the channel statistics and the tile maps of a layer, top to bottom
+def _write_tile_maps(workbook, sheet, error, ave_error, tileSizes):
+    sheet.write('D1','Average : ')
+    sheet.write('E1',ave_error)
+
+    #one row per channel
+    channels = channel_stats(error, THRESHOLD)
+    numChannels = len(channels['mean'])
+    sheet.write_row(2, 0, ['channel', 'mean', 'min', 'fraction <= ' + str(THRESHOLD)])
+    for c in range(numChannels):
+        sheet.write_row(3 + c, 0, [c, channels['mean'][c].item(), channels['min'][c].item(), channels['below'][c].item()])
+    _color(workbook, sheet, (3, 1, 2 + numChannels, 2))
+
+    #the three maps of each tile size next to each other with a blank column between them
+    row = 4 + numChannels
+    for level in tile_pyramid(error, tileSizes, THRESHOLD):
+        maps = [level[key].reshape(-1, level[key].shape[2]) for key in ('mean', 'min', 'below')]
+        numRows, numCols = maps[0].shape
+        title = '{}x{} tiles'.format(level['tile'][0], level['tile'][1])
+        sheet.write_row(row, 0, ['mean of ' + title] + [None] * numCols + ['min of ' + title] + [None] * numCols + ['fraction <= ' + str(THRESHOLD) + ' of ' + title])
+        for i in range(numRows):
+            sheet.write_row(row + 1 + i, 0, maps[0][i].tolist() + [None] + maps[1][i].tolist() + [None] + maps[2][i].tolist())
+
+        _color(workbook, sheet, (row + 1, 0, row + numRows, 2 * numCols))
+        sheet.conditional_format(row + 1, 2 * numCols + 2, row + numRows, 3 * numCols + 1,
+                                 {'type': '2_color_scale', 'min_type': 'num', 'min_value': 0, 'min_color': '#FFFFFF',
+                                  'max_type': 'num', 'max_value': 1, 'max_color': '#FF0000'})
+        row += numRows + 2
+
+
+
+
+#writes the lowest similarities of a layer with where they are and the values they came from
+def _write_worst(sheet, caffe, cpp, error, worst):
+    index, values = worst_cells(error, worst)
+    names = {1: ['index'], 2: ['row', 'column'], 3: ['channel', 'row', 'column']}.get(error.ndim)
+    if names is None:
+        names = ['dim ' + str(d) for d in range(error.ndim)]
+
+    sheet.write_row(0, 0, names + ['caffe', 'cpp', 'error'])
+    position = np.stack(index, axis=1).tolist() if len(index) else [[] for _ in values]
+    caffeValues = caffe[index].tolist()
+    cppValues = cpp[index].tolist()
+    for i, value in enumerate(values.tolist()):
+        sheet.write_row(i + 1, 0, position[i] + [caffeValues[i], cppValues[i], value])
+
+
+
+
+'''
+    Description:
+        writes the metrics of one layer from metrics.layer_metrics: the whole layer on the first two rows and one row per
+        channel below them, with the similarities colored the same way as the error sheet
+    Inputs:
+        workbook - workbook created by create_report
+        layerMetrics - dict returned by layer_metrics
+        metricsSheetName - string name of the metrics sheet. If nothing is provided will default to Sheet1, Sheet2, etc.
+        record - optional function returning a context manager the sheet is written in, see write_layer. It is written in
+                 the 'metrics sheet' stage.
+    Outputs:
+        does not return anything but a sheet has been added to the workbook
+'''
+def write_metrics(workbook, layerMetrics, metricsSheetName=None, record=None):
+
+    if record is None:
+        record = lambda name: nullcontext()
+
+    channels = layerMetrics['channels']
+    numChannels = len(channels['similarity'])
+    assert 4 + numChannels <= MAX_ROWS
+    sheet = workbook.add_worksheet(metricsSheetName)
+
+    with record('metrics sheet'):
+        sheet.write_row(0, 0, ['layer'] + METRICS)
+        sheet.write_row(1, 0, ['all'] + [float(layerMetrics[key]) for key in METRICS])
+        _color(workbook, sheet, (1, 1, 1, 1))
+
+        #one row per channel
+        columns = [channels[key].tolist() for key in METRICS]
+        sheet.write_row(3, 0, ['channel'] + METRICS)
+        for c in range(numChannels):
+            sheet.write_row(4 + c, 0, [c] + [column[c] for column in columns])
+        if numChannels:
+            _color(workbook, sheet, (4, 1, 3 + numChannels, 1))
+
+
+
+
+'''
+    Description:
+        writes the summary of a batch of images from batch.batch_compare: a summary sheet with a row of statistics across
+        the images for every layer, and an images sheet with the average similarity of every image (rows) and layer (columns)
+    Inputs:
+        workbook - workbook created by create_report
+        results - dict returned by batch_compare
+        threshold - images whose average similarity is at or below this are counted as failing
+    Outputs:
+        does not return anything but two sheets have been added to the workbook
+'''
+def write_batch_summary(workbook, results, threshold=THRESHOLD):
+    images = results['images'].tolist()
+    layers = results['layers'].tolist()
+
+    summarySheet = workbook.add_worksheet('summary')
+    summarySheet.write_row(0, 0, ['layer', 'images', 'mean similarity', 'lowest similarity', 'worst image', 'failing images',
+                                  'mean fraction <= ' + str(threshold), 'mean cosine', 'lowest snr'])
+    for j, layer in enumerate(layers):
+        sim = results[layer + '/similarity']
+        if len(sim) == 0:
+            summarySheet.write_row(j + 1, 0, [layer, 0])
+            continue
+        worst = int(np.argmin(sim))
+        summarySheet.write_row(j + 1, 0, [layer, len(sim), float(np.mean(sim)), float(sim[worst]), images[worst],
+                                          int(np.count_nonzero(sim <= threshold)), float(np.mean(results[layer + '/below'])),
+                                          float(np.mean(results[layer + '/cosine'])), float(np.min(results[layer + '/snr']))])
+    if layers and images:
+        _color(workbook, summarySheet, (1, 2, len(layers), 3), value=threshold)
+
+    imageSheet = workbook.add_worksheet('images')
+    imageSheet.write_row(0, 0, ['image'] + layers)
+    columns = np.stack([results[layer + '/similarity'] for layer in layers], axis=1) if layers else np.zeros((len(images), 0))
+    for i, image in enumerate(images):
+        imageSheet.write_row(i + 1, 0, [image] + columns[i].tolist())
+    if layers and images:
+        _color(workbook, imageSheet, (1, 1, len(images), len(layers)), value=threshold)
+
+
+
+
+'''
+    Description:
+        writes an array to a sheet starting on the second row. 2 dimensional arrays are written one row per row, 1 dimensional
+        arrays down the second column.
+    Inputs:
+        sheet - xlsxwriter worksheet to write to
+        arr - 1 or 2 dimensional array
+    Outputs:
+        does not return anything but the sheet has been filled
+'''
+def write_array(sheet, arr):
+    #the first row is taken by the headers
+    assert arr.shape[0] < MAX_ROWS and (len(arr.shape) != 2 or arr.shape[1] <= MAX_COLS)
+
+    #tolist converts a block to python floats in one go, which xlsxwriter writes much faster than numpy scalars.
+    #Going a row or block at a time keeps those lists small
+    if len(arr.shape) == 2:
+        for i in range(arr.shape[0]):
+            sheet.write_row(i+1, 0, arr[i].tolist())
+    else:
+        for start in range(0, arr.shape[0], COLUMN_BLOCK):
+            sheet.write_column(start+1, 1, arr[start:start+COLUMN_BLOCK].tolist())
+
+
+
+
+#returns the (first_row, first_col, last_row, last_col) cells that write_array fills for an array
+def data_range(arr):
+    if len(arr.shape) == 2:
+        return 1, 0, arr.shape[0], arr.shape[1] - 1
+    return 1, 1, arr.shape[0], 1
@@ -0,0 +1,324 @@
+import numpy as np
+from decimal import *
+from loader import RAW_HEADER
+from constants import BLOCK_SIZE
+
+
+
+
+#number of values handled at a time by the numpy formatting path, small enough to stay in cache
+FAST_BLOCK = 1 << 16
+
+#exact powers of ten used to scale values into integers of the wanted number of digits
+_TEN_OFFSET = 64
+_TEN = np.array([float('1e' + str(k)) for k in range(-_TEN_OFFSET, _TEN_OFFSET + 1)])
+
+#what Decimal makes of str(0.0) and str(-0.0)
+_ZERO = "{:.8E}".format(Decimal('0.0'))
+_NEG_ZERO = "{:.8E}".format(Decimal('-0.0'))
+
+#distance from a rounding decision within which the float64 arithmetic is not trusted
+_MARGIN = 1e-6
+
+#number of values on each line of the fc weight arrays
+FC_VALUES_PER_LINE = 8
+
+
+
+
+'''
+    Description:
+        formats every value of an array the way write_caffe_files always has, "{:.8E}".format(Decimal(str(x))).
+        str() of a float32 is its shortest round trip representation, which has at most 9 digits, so the output is just
+        those digits padded with zeros. For normal float32 values the shortest digits are found with numpy
+        (_shortest_digits) and the strings are assembled as a byte matrix; everything else (zeros, subnormals, inf/nan,
+        other dtypes and the rare value that lands too close to a rounding boundary to decide in float64) goes through
+        Decimal, except zeros which always come out the same. Each distinct value on the Decimal path is only formatted once.
+    Inputs:
+        arr - numpy array of any shape
+    Outputs:
+        returns a list of strings, one per value in C order
+'''
+def format_values(arr):
+    flat = np.ascontiguousarray(arr).reshape(-1)
+    if flat.size == 0:
+        return []
+
+    #float32 strings are at most 15 characters, e.g. -1.40129846E-45
+    strs = np.empty(flat.size, dtype='U15' if flat.dtype == np.float32 else object)
+    exact = np.ones(flat.size, dtype=bool)
+
+    #work in blocks small enough to stay in cache
+    if flat.dtype == np.float32:
+        for start in range(0, flat.size, FAST_BLOCK):
+            block = flat[start:start + FAST_BLOCK]
+            digits, exponent, ok = _shortest_digits(block)
+            strs[start:start + len(block)][ok] = _assemble(digits[ok], exponent[ok], np.signbit(block[ok]))
+
+            #str() of a zero is always 0.0 or -0.0
+            zero = block == 0
+            strs[start:start + len(block)][zero] = np.where(np.signbit(block[zero]), _NEG_ZERO, _ZERO)
+            exact[start:start + len(block)] = ~(ok | zero)
+
+    rest = np.flatnonzero(exact)
+    if len(rest):
+        vals = flat[rest]
+        bits = vals.view('u' + str(vals.dtype.itemsize))
+        uniq, inverse = np.unique(bits, return_inverse=True)
+        formatted = np.array(["{:.8E}".format(Decimal(str(x))) for x in uniq.view(vals.dtype)], dtype=strs.dtype)
+        strs[rest] = formatted[inverse.reshape(-1)]
+
+    return strs.tolist()
+
+
+
+
+#finds the shortest round trip decimal digits of normal float32 values. Returns the digits padded to a 9 digit integer,
+#the decimal exponent, and a mask of the values that were decided. Every comparison is made with a margin far larger than
+#the float64 rounding error, anything inside the margin is left for Decimal.
+def _shortest_digits(x):
+    n = len(x)
+    ax32 = np.abs(x)
+    ok = np.isfinite(ax32) & (ax32 >= np.finfo(np.float32).tiny)
+    ax32 = np.where(ok, ax32, np.float32(1))
+
+    #the float32 above FLT_MAX is inf, so its gap can not be measured and FLT_MAX is left for Decimal
+    with np.errstate(over='ignore'):
+        up = np.nextafter(ax32, np.float32(np.inf))
+    ok &= np.isfinite(up)
+    ax32 = np.where(ok, ax32, np.float32(1))
+    ax = ax32.astype(np.float64)
+
+    #decimal exponent, corrected where log10 rounded across a power of ten
+    e = np.floor(np.log10(ax)).astype(np.int64)
+    e[ax >= _TEN[e + _TEN_OFFSET + 1]] += 1
+    e[ax < _TEN[e + _TEN_OFFSET]] -= 1
+    ok &= (np.abs(ax / _TEN[e + _TEN_OFFSET] - 1) > 1e-12) & (np.abs(ax / _TEN[e + _TEN_OFFSET + 1] - 1) > 1e-12)
+
+    #half the gap to each neighbouring float32, anything closer than that reads back as the same value
+    halfHi = (up.astype(np.float64) - ax) / 2
+    halfLo = (ax - np.nextafter(ax32, np.float32(0)).astype(np.float64)) / 2
+
+    #9 digits always round trip. Keep dropping a digit while the closest candidate still does
+    digits = np.zeros(n, dtype=np.int64)
+    idx = np.flatnonzero(ok)
+    for p in range(9, 0, -1):
+        k = p - 1 - e[idx]
+        pos = k >= 0
+        scale = _TEN[np.abs(k) + _TEN_OFFSET]
+        scaled = np.where(pos, ax[idx] * scale, ax[idx] / scale)
+        gapLo = np.where(pos, halfLo[idx] * scale, halfLo[idx] / scale)
+        gapHi = np.where(pos, halfHi[idx] * scale, halfHi[idx] / scale)
+
+        lo = np.floor(scaled)
+        frac = scaled - lo
+        loOk = frac < gapLo
+        hiOk = (1 - frac) < gapHi
+        both = loOk & hiOk
+        unsure = (np.abs(frac - gapLo) < _MARGIN) | (np.abs(1 - frac - gapHi) < _MARGIN) | (both & (np.abs(frac - 0.5) < _MARGIN))
+        ok[idx[unsure]] = False
+
+        hit = (loOk | hiOk) & ~unsure
+        m = np.where(loOk & ~(both & (frac > 0.5)), lo, lo + 1)
+        idx = idx[hit]
+        digits[idx] = m[hit].astype(np.int64) * 10 ** (9 - p)
+        if len(idx) == 0:
+            break
+
+    #rounding up to the next power of ten, e.g. 9.99999999 to 10
+    over = digits >= 10 ** 9
+    digits[over] //= 10
+    e[over] += 1
+    return digits, e, ok
+
+
+
+
+#builds the strings "[-]d.ddddddddE+x" for 9 digit integers and exponents as a matrix of UCS4 characters, which numpy
+#can view directly as a U15 array
+def _assemble(digits, exponent, negative):
+    n = len(digits)
+    body = np.zeros((n, 14), dtype=np.uint32)
+
+    #split into 5 and 4 digit halves so the digits come out of cheaper int32 divisions
+    high, low = np.divmod(digits.astype(np.int32), 10000)
+    for i in range(5):
+        body[:, 0 if i == 0 else i + 1] = high // 10 ** (4 - i) % 10 + ord('0')
+    for i in range(4):
+        body[:, i + 6] = low // 10 ** (3 - i) % 10 + ord('0')
+    body[:, 1] = ord('.')
+    body[:, 10] = ord('E')
+    body[:, 11] = np.where(exponent < 0, ord('-'), ord('+'))
+    ea = np.abs(exponent)
+    two = ea >= 10
+    body[:, 12] = np.where(two, ea // 10, ea) + ord('0')
+    body[:, 13] = np.where(two, ea % 10 + ord('0'), 0)
+
+    out = np.zeros((n, 15), dtype=np.uint32)
+    out[~negative, :14] = body[~negative]
+    out[negative, 0] = ord('-')
+    out[negative, 1:] = body[negative]
+
+    #trailing zero characters are dropped by the conversion to str
+    return out.view('U15').reshape(-1)
+
+
+
+
+'''
+    Description:
+        formats a 2 dimensional array a block of rows at a time
+    Inputs:
+        M - 2 dimensional numpy array
+        blockSize - roughly how many values to format at a time
+    Outputs:
+        yields one list of formatted strings per row of M
+'''
+def format_rows(M, blockSize=BLOCK_SIZE):
+    numCols = M.shape[1]
+    rowsPerBlock = max(1, blockSize // max(numCols, 1))
+    for start in range(0, M.shape[0], rowsPerBlock):
+        vals = format_values(M[start:start + rowsPerBlock])
+        for r in range(0, len(vals), numCols):
+            yield vals[r:r + numCols]
+
+
+
+
+'''
+    Description:
+        writes a blob in the 2D text form write_caffe_files uses, one row per line with every value surrounded by two spaces.
+        4 dimensional blobs get a line for each row of every channel, 2 dimensional (fc) blobs are written transposed.
+        Any other shape writes nothing.
+    Inputs:
+        out_file - file object to write to
+        W - the blob's data
+    Outputs:
+        does not return anything but the blob has been written to out_file
+'''
+def write_blob(out_file, W):
+    if len(W.shape) == 4:
+        M = W.reshape(-1, W.shape[3])
+    elif len(W.shape) == 2:
+        M = W.T
+    else:
+        return
+
+    for row in format_rows(M):
+        out_file.write("  " + "  ".join(row) + "  \n")
+
+
+
+
+'''
+    Description:
+        writes a blob as a binary dump that loader.load_binary memory maps, either a .npy file or the raw little endian
+        values after a RAW_HEADER line. A leading batch dimension of 1 is dropped so the shape matches the caffe text dumps.
+    Inputs:
+        out_file - file object opened in binary mode
+        W - the blob's data
+        fmt - 'npy' or 'raw'
+    Outputs:
+        does not return anything but the blob has been written to out_file
+'''
+def write_binary_blob(out_file, W, fmt='npy'):
+    if len(W.shape) > 1 and W.shape[0] == 1:
+        W = W[0]
+    W = np.ascontiguousarray(W, dtype=W.dtype.newbyteorder('<'))
+
+    if fmt == 'npy':
+        np.save(out_file, W)
+    elif fmt == 'raw':
+        out_file.write(RAW_HEADER + 'dtype={} shape={}\n'.format(W.dtype.str, ','.join(map(str, W.shape))).encode('ascii'))
+        out_file.write(memoryview(W.reshape(-1)))
+    else:
+        raise ValueError('unknown binary format ' + str(fmt))
+
+
+
+
+'''
+    Description:
+        writes 4 dimensional conv weights as one 3 dimensional c++ array initializer, {{{...}, {...}}, {{...}}};
+    Inputs:
+        out_file - file object to write to
+        W - weights with shape (kernels, channels, rows, columns)
+    Outputs:
+        does not return anything but the array has been written to out_file
+'''
+def write_weights_3d(out_file, W):
+    numRows = W.shape[2]
+    out_file.write("{")
+    block = []
+    for n, row in enumerate(format_rows(W.reshape(-1, W.shape[3]))):
+        block.append("{" + ", ".join(row) + "}")
+
+        #end of one kernel's channel
+        if len(block) == numRows:
+            if n + 1 > numRows:
+                out_file.write(",\n\n")
+            out_file.write("{" + ",\n".join(block) + "}")
+            block = []
+    out_file.write("};")
+
+
+
+
+'''
+    Description:
+        writes 4 dimensional conv weights as a separate 2 dimensional c++ array initializer for every kernel and channel,
+        each preceded by a "kernel i/n channel j/m" line
+    Inputs:
+        out_file - file object to write to
+        W - weights with shape (kernels, channels, rows, columns)
+    Outputs:
+        does not return anything but the arrays have been written to out_file
+'''
+def write_weights_2d(out_file, W):
+    numKernels, numChannels, numRows = W.shape[0], W.shape[1], W.shape[2]
+    block = []
+    for n, row in enumerate(format_rows(W.reshape(-1, W.shape[3]))):
+        block.append("{" + ", ".join(row) + "}")
+
+        #end of one kernel's channel
+        if len(block) == numRows:
+            i, j = divmod(n // numRows, numChannels)
+            out_file.write("kernel {}/{} channel {}/{}\n".format(i+1, numKernels, j+1, numChannels))
+            out_file.write("{" + ",\n".join(block) + "};\n\n")
+            block = []
+
+
+
+
+'''
+    Description:
+        writes a slice of 2 dimensional fc weights as a c++ array initializer, FC_VALUES_PER_LINE values to a line
+    Inputs:
+        out_file - file object to write to
+        W - the rows of the weights that go in this file
+    Outputs:
+        does not return anything but the array has been written to out_file
+'''
+def write_fc_weights(out_file, W):
+    out_file.write("{")
+    for n, row in enumerate(format_rows(W)):
+        if n:
+            out_file.write(",\n")
+        lines = [", ".join(row[i:i + FC_VALUES_PER_LINE]) for i in range(0, len(row), FC_VALUES_PER_LINE)]
+        out_file.write("{" + ", \n".join(lines) + "}")
+    out_file.write("};\n\n")
+
+
+
+
+'''
+    Description:
+        writes a bias vector as a c++ array initializer, one value per line
+    Inputs:
+        out_file - file object to write to
+        B - the layer's bias
+    Outputs:
+        does not return anything but the array has been written to out_file
+'''
+def write_bias(out_file, B):
+    out_file.write("{ " + ",\n ".join(format_values(B)) + " };")
@@ -0,0 +1,78 @@
+import math
+import numpy as np
+from loader import iter_blocks
+from metrics import relative_difference
+from constants import BLOCK_SIZE, THRESHOLD
+
+
+
+
+'''
+    Description:
+        calculates the same similarity as compare, but walks through both files block by block instead of loading them
+        whole, so layers larger than memory can be compared. Peak memory is a few blocks no matter how large the files are.
+    Inputs:
+        caffetxt - string name of file where the caffe layer's output is stored
+        cpptxt - the cpp layer's output: a file name, or a glob pattern or list for a layer split across shards like
+                 'vivado/conv1out*.txt', see loader.load_source. Binary dumps are read from a memory map.
+        blockSize - number of values from each file held in memory at once
+        threshold - error values at or below this are counted as failing
+        bins - number of histogram bins between 0 and 1. Values outside that range are counted in 'under' and 'over'.
+    Outputs:
+        returns a dict with
+            count - number of values compared
+            average - average error, the ave_error compare writes to the error sheet. It is identical when the layer fits in
+                      one block; with more blocks the block sums are added exactly with math.fsum, so it can only differ in
+                      the last bit of rounding.
+            min, max - smallest and largest error
+            below - number of errors at or below threshold
+            histogram, bin_edges - histogram of the errors between 0 and 1
+            under, over - number of errors below 0 and above 1
+            shape - shape of the caffe tensor, as load_txt would return it
+'''
+def stream_stats(caffetxt, cpptxt, blockSize=BLOCK_SIZE, threshold=THRESHOLD, bins=20):
+
+    caffeInfo = {}
+    cppInfo = {}
+    caffeBlocks = iter_blocks(caffetxt, blockSize, np.float64, caffeInfo)
+    cppBlocks = iter_blocks(cpptxt, blockSize, np.float64, cppInfo)
+
+    count = 0
+    sums = []
+    lo = np.inf
+    hi = -np.inf
+    below = 0
+    under = 0
+    over = 0
+    bin_edges = np.linspace(0, 1, bins + 1)
+    histogram = np.zeros(bins, dtype=np.int64)
+
+    for caffe in caffeBlocks:
+        cpp = next(cppBlocks, None)
+        assert cpp is not None and len(cpp) == len(caffe)
+
+        #same formula as compare, done in place on the block to avoid extra temporaries
+        error = relative_difference(caffe, cpp, inPlace=True)
+        np.subtract(1, error, out=error)
+
+        count += len(error)
+        sums.append(float(np.sum(error)))
+        lo = min(lo, float(error.min()))
+        hi = max(hi, float(error.max()))
+        below += int(np.count_nonzero(error <= threshold))
+        under += int(np.count_nonzero(error < 0))
+        over += int(np.count_nonzero(error > 1))
+        histogram += np.histogram(error, bins=bin_edges)[0]
+
+    assert next(cppBlocks, None) is None
+
+    return {'count': count,
+            'average': math.fsum(sums) / count if count else np.nan,
+            'min': lo,
+            'max': hi,
+            'below': below,
+            'histogram': histogram,
+            'bin_edges': bin_edges,
+            'under': under,
+            'over': over,
+            'shape': caffeInfo['shape']}
@@ -0,0 +1,159 @@
+import numpy as np
+from constants import BLOCK_SIZE, THRESHOLD
+
+
+
+
+#number of lowest similarities written to the report by default
+WORST_CELLS = 100
+
+
+
+
+'''
+    Description:
+        reduces an error map to per tile statistics at several tile sizes, for every channel. Tiles are tileSize x tileSize
+        cells of a channel, the ones on the bottom and right edges are smaller when the size does not divide the channel.
+        The finest size is computed from the error a block of channels at a time; every coarser size that is a multiple of
+        the one before it is built from that level instead of going over the error again.
+    Inputs:
+        error - array of the similarity of every value, in the layer's tensor shape. 3 dimensional arrays are (channels,
+                rows, cols), more dimensions are folded into the channels, a 2 dimensional array is one channel and a
+                1 dimensional one a single row.
+        tileSizes - list of tile sizes, e.g. [8, 32]
+        threshold - similarities at or below this count as failing
+    Outputs:
+        returns a list with a dict for each tile size, smallest first, holding
+            tile - (rows, cols) of a full tile
+            mean - mean similarity of every tile, shape (channels, tile rows, tile cols)
+            min - lowest similarity of every tile
+            below - fraction of every tile at or below threshold
+'''
+def tile_pyramid(error, tileSizes, threshold=THRESHOLD):
+    error = as_channels(error)
+    numChannels, numRows, numCols = error.shape
+
+    levels = []
+    prev = None
+    for size in sorted(set(tileSizes)):
+        tile = (min(size, numRows), min(size, numCols))
+        if prev is not None and tile[0] % prev['tile'][0] == 0 and tile[1] % prev['tile'][1] == 0:
+            level = _coarsen(prev, tile)
+        else:
+            level = _tile_sums(error, tile, threshold)
+        levels.append(level)
+        prev = level
+
+    return [{'tile': level['tile'],
+             'mean': level['sum'] / level['count'],
+             'min': level['min'],
+             'below': level['below'] / level['count']} for level in levels]
+
+
+
+
+'''
+    Description:
+        statistics of each channel of an error map, the same as tile_pyramid with one tile covering the whole channel
+    Inputs:
+        error - array of the similarity of every value, see tile_pyramid
+        threshold - similarities at or below this count as failing
+    Outputs:
+        returns a dict of 1 dimensional arrays with one value per channel: mean, min and below, the fraction at or below threshold
+'''
+def channel_stats(error, threshold=THRESHOLD):
+    error = as_channels(error)
+    level = tile_pyramid(error, [max(error.shape[1:])], threshold)[0]
+    return {key: level[key].reshape(-1) for key in ('mean', 'min', 'below')}
+
+
+
+
+'''
+    Description:
+        finds the lowest similarities of an error map without sorting or copying all of it. Candidates are taken from one
+        block at a time, so memory does not grow with the layer.
+    Inputs:
+        error - array of the similarity of every value
+        k - number of cells to find
+    Outputs:
+        returns (index, values): index is a tuple of arrays with the position of each cell in error's shape, values their
+        similarities, lowest first
+'''
+def worst_cells(error, k=WORST_CELLS):
+    flat = error.reshape(-1)
+    k = min(k, flat.size)
+    if k == 0:
+        return np.unravel_index(np.zeros(0, dtype=np.int64), error.shape), flat[:0]
+
+    candidates = []
+    for start in range(0, flat.size, BLOCK_SIZE):
+        block = flat[start:start + BLOCK_SIZE]
+        keep = min(k, len(block))
+        idx = np.argpartition(block, keep - 1)[:keep]
+        candidates.append(idx + start)
+
+    idx = np.concatenate(candidates)
+    idx = idx[np.argsort(flat[idx], kind='stable')[:k]]
+    return np.unravel_index(idx, error.shape), flat[idx]
+
+
+
+
+'''
+    Description:
+        views an array as (channels, rows, cols), the layout the tile statistics are worked out in
+    Inputs:
+        arr - numpy array of any shape
+    Outputs:
+        returns a 3 dimensional view of arr
+'''
+def as_channels(arr):
+    if arr.ndim == 0:
+        return arr.reshape(1, 1, 1)
+    if arr.ndim == 1:
+        return arr.reshape(1, 1, -1)
+    return arr.reshape(-1, arr.shape[-2], arr.shape[-1])
+
+
+
+
+#sums, minimums, failing counts and sizes of every tile, straight from the error
+def _tile_sums(error, tile, threshold):
+    numChannels, numRows, numCols = error.shape
+    rows = np.arange(0, numRows, tile[0])
+    cols = np.arange(0, numCols, tile[1])
+    shape = (numChannels, len(rows), len(cols))
+    sums = np.zeros(shape)
+    mins = np.zeros(shape)
+    below = np.zeros(shape, dtype=np.int64)
+
+    step = max(1, BLOCK_SIZE // max(numRows * numCols, 1))
+    for c0 in range(0, numChannels, step):
+        e = np.asarray(error[c0:c0 + step], dtype=np.float64)
+        sums[c0:c0 + step] = _reduce(np.add, e, rows, cols)
+        mins[c0:c0 + step] = _reduce(np.minimum, e, rows, cols)
+        below[c0:c0 + step] = _reduce(np.add, (e <= threshold).astype(np.int64), rows, cols)
+
+    count = np.outer(np.diff(np.append(rows, numRows)), np.diff(np.append(cols, numCols)))
+    return {'tile': tile, 'sum': sums, 'min': mins, 'below': below, 'count': count}
+
+
+
+
+#combines the tiles of a finer level into tiles of a size that is a multiple of it
+def _coarsen(level, tile):
+    rows = np.arange(0, level['sum'].shape[1], tile[0] // level['tile'][0])
+    cols = np.arange(0, level['sum'].shape[2], tile[1] // level['tile'][1])
+    return {'tile': tile,
+            'sum': _reduce(np.add, level['sum'], rows, cols),
+            'min': _reduce(np.minimum, level['min'], rows, cols),
+            'below': _reduce(np.add, level['below'], rows, cols),
+            'count': _reduce(np.add, level['count'][np.newaxis], rows, cols)[0]}
+
+
+
+
+#applies a ufunc over the tiles starting at the given rows and cols of the last two axes
+def _reduce(ufunc, arr, rows, cols):
+    return ufunc.reduceat(ufunc.reduceat(arr, rows, axis=1), cols, axis=2)